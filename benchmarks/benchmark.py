@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+"""
+Time the hot paths in nonstdlib, and check for regressions.
+
+Usage:
+    benchmark.py run [-o <json>] [-k <pattern>] [-r <repeat>]
+    benchmark.py compare <baseline> <results> [-t <threshold>]
+    benchmark.py list
+
+The 'run' command times each benchmark at several input sizes and writes the
+results (the best time per call, in seconds) to a JSON file.  The 'compare'
+command reads two such files and reports any benchmark that got slower by more
+than the given threshold (10% by default).  It exits with a non-zero status if
+there were any regressions, so it can be used in CI.  Everything runs offline,
+using only the standard library (plus numpy, for the benchmarks that need it).
+
+A typical workflow is to save a baseline from the last release, then compare
+against it after making changes:
+
+    $ git checkout v1.12.0
+    $ python benchmarks/benchmark.py run -o baseline.json
+    $ git checkout master
+    $ python benchmarks/benchmark.py run -o results.json
+    $ python benchmarks/benchmark.py compare baseline.json results.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import timeit
+import logging
+import argparse
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import nonstdlib
+
+BENCHMARKS = []
+
+def benchmark(*sizes):
+    """
+    Register a benchmark to be run at each of the given sizes.
+
+    The decorated function is called once per size, and should do any setup
+    that shouldn't be timed.  It should return a function with no arguments,
+    which is what actually gets timed.  Benchmarks that need optional
+    dependencies can raise ImportError to be skipped.
+    """
+    def decorator(setup):
+        BENCHMARKS.append((setup.__name__, sizes, setup))
+        return setup
+    return decorator
+
+def time_call(function, repeat=5):
+    """
+    Return the best time per call for the given function, in seconds.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+## Benchmarks
+
+@benchmark(10, 1000, 100000)
+def approx_list(n):
+    expected = [float(i) for i in range(1, n + 1)]
+    actual = [x * (1 + 1e-9) for x in expected]
+    x = nonstdlib.approx(expected)
+    return lambda: actual == x
+
+@benchmark(10, 1000, 100000, 10000000)
+def approx_numpy(n):
+    import numpy as np
+    expected = np.arange(1, n + 1, dtype=float)
+    actual = expected * (1 + 1e-9)
+    x = nonstdlib.approx(expected)
+    return lambda: actual == x
+
+@benchmark(10, 1000, 100000)
+def approx_construct(n):
+    expected = [float(i) for i in range(1, n + 1)]
+    return lambda: nonstdlib.approx(expected)
+
+@benchmark(1, 10, 100)
+def debug_log(depth):
+    _configure_logging(logging.DEBUG)
+
+    def log():
+        x = 42
+        nonstdlib.info("message {x}")
+
+    return _at_depth(depth, log)
+
+@benchmark(1, 10, 100)
+def debug_log_disabled(depth):
+    _configure_logging(logging.WARNING)
+
+    def log():
+        x = 42
+        nonstdlib.debug("message {x}")
+
+    return _at_depth(depth, log)
+
+@benchmark(1, 10, 100)
+def debug_log_limited(depth):
+    _configure_logging(logging.DEBUG)
+
+    def log():
+        x = 42
+        nonstdlib.info("message {x}", limit=1, interval=3600)
+
+    return _at_depth(depth, log)
+
+@benchmark(1, 10, 100)
+def debug_log_noop(depth):
+    # The cost of getting to the given depth, for comparison with the disabled 
+    # logging benchmark.
+
+    def log():
+        x = 42
+
+    return _at_depth(depth, log)
+
+@benchmark(1, 10, 100)
+def fmt(n):
+    from nonstdlib import fmt
+
+    def format():
+        words = ['word'] * n
+        return '{words}' | fmt
+
+    return format
+
+@benchmark(10, 1000, 100000)
+def capture_output(n):
+    def write():
+        with nonstdlib.capture_output(muffle=True):
+            for i in range(n):
+                sys.stdout.write('line\n')
+    return write
+
+@benchmark(10, 1000)
+def proc_tee(n):
+    command = [sys.executable, '-c', 'for i in range({}): print(i)'.format(n)]
+
+    def tee():
+        with nonstdlib.muffle():
+            nonstdlib.tee(command, universal_newlines=True)
+
+    return tee
+
+@benchmark(1, 10, 100)
+def meta_memoize(n):
+    @nonstdlib.memoize
+    def function(*args):
+        return args
+
+    args = tuple(range(n))
+    function(*args)
+    return lambda: function(*args)
+
+@benchmark(10, 1000, 100000)
+def text_pretty_range(n):
+    indices = [i for i in range(n) if i % 7]
+    return lambda: nonstdlib.pretty_range(indices)
+
+@benchmark(10, 100, 1000)
+def misc_slugify(n):
+    title = ('Hello (World) & Friends: ' * n)[:n]
+    return lambda: nonstdlib.slugify(title)
+
+def _configure_logging(level):
+    root = logging.getLogger()
+    root.handlers = [logging.NullHandler()]
+    root.setLevel(level)
+
+def _at_depth(depth, function):
+    # Call the given function from the given depth in the call stack, since
+    # the debug helpers have to look up the stack to find their caller.
+    def call(depth):
+        return function() if depth <= 1 else call(depth - 1)
+    return lambda: call(depth)
+
+
+## Commands
+
+def run(args):
+    pattern = re.compile(args.pattern) if args.pattern else None
+    results = {}
+
+    for name, sizes, setup in BENCHMARKS:
+        for size in sizes:
+            key = '{}[{}]'.format(name, size)
+            if pattern and not pattern.search(key):
+                continue
+
+            try:
+                function = setup(size)
+            except ImportError as error:
+                print('{:<32} skipped ({})'.format(key, error))
+                continue
+
+            results[key] = time_call(function, args.repeat)
+            print('{:<32} {}'.format(key, format_time(results[key])))
+            sys.stdout.flush()
+
+    if args.output:
+        data = {
+                'nonstdlib': nonstdlib.__version__,
+                'python': platform.python_version(),
+                'machine': platform.platform(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results,
+        }
+        with open(args.output, 'w') as file:
+            json.dump(data, file, indent=2, sort_keys=True)
+
+def compare(args):
+    with open(args.baseline) as file:
+        baseline = json.load(file)['results']
+    with open(args.results) as file:
+        results = json.load(file)['results']
+
+    regressions = 0
+
+    for key in sorted(set(baseline) & set(results)):
+        ratio = results[key] / baseline[key]
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = 'improved'
+
+        print('{:<32} {:>10} {:>10} {:>7.2f}x  {}'.format(
+            key,
+            format_time(baseline[key]),
+            format_time(results[key]),
+            ratio,
+            flag,
+        ))
+
+    for key in sorted(set(baseline) - set(results)):
+        print('{:<32} missing from results'.format(key))
+
+    if regressions:
+        print('\n{} benchmark(s) slower by more than {:.0%}.'.format(
+            regressions, args.threshold))
+        sys.exit(1)
+
+def list_benchmarks(args):
+    for name, sizes, setup in BENCHMARKS:
+        print('{}: {}'.format(name, ', '.join(str(x) for x in sizes)))
+
+def format_time(seconds):
+    for unit, scale in [('s', 1), ('ms', 1e-3), ('us', 1e-6)]:
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds / 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run',
+            help="time each benchmark")
+    run_parser.add_argument('-o', '--output', metavar='<json>',
+            help="write the results to the given JSON file")
+    run_parser.add_argument('-k', '--pattern', metavar='<pattern>',
+            help="only run benchmarks matching the given regular expression")
+    run_parser.add_argument('-r', '--repeat', metavar='<repeat>',
+            type=int, default=5,
+            help="how many times to repeat each measurement (default: 5)")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = commands.add_parser('compare',
+            help="check for regressions against a baseline")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('-t', '--threshold', metavar='<threshold>',
+            type=float, default=0.1,
+            help="fractional slowdown that counts as a regression (default: 0.1)")
+    compare_parser.set_defaults(function=compare)
+
+    list_parser = commands.add_parser('list',
+            help="list the available benchmarks")
+    list_parser.set_defaults(function=list_benchmarks)
+
+    args = parser.parse_args()
+    args.function(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import sys, math
+import os, sys, math, collections
 
 class approx(object):
     """
@@ -76,6 +76,41 @@ class approx(object):
         >>> 1 + 1e-8 == approx(1, rel=1e-6, abs=1e-12)
         True
 
+    Large arrays of numbers are best compared using numpy arrays, which
+    ``approx`` compares without any python-level loops.  Memory-mapped files,
+    ``memoryview`` and ``array.array`` objects are compared in place, without
+    being copied.  Raw binary files can be compared by giving their path and
+    the ``dtype`` of the numbers they contain, e.g.::
+
+        assert 'actual.bin' == approx('expected.bin', dtype='float64')
+
+    Dictionaries, nested lists, dataclasses and numpy structured arrays are
+    compared recursively, so whole records can be compared at once::
+
+        assert {'x': 0.1 + 0.2, 'y': [0.2 + 0.4, 'z']} == \
+                approx({'x': 0.3, 'y': [0.6, 'z']})
+
+    Numbers are compared approximately, and anything else (e.g. strings and
+    dictionary keys) is compared exactly.
+
+    Generators and other iterables without a length are compared one chunk at
+    a time, so they never have to be held in memory all at once.  Very large
+    arrays can be compared using several threads at once by passing the
+    ``threads`` argument (``threads=True`` uses one thread per CPU).
+
+    Numerical code is sometimes best tested by asking whether two numbers are
+    within a certain number of `units in the last place`__ (ULPs), i.e.
+    whether there are only a few representable floating-point numbers between
+    them.  Use the ``ulps`` argument to make this kind of comparison.  Like
+    ``abs``, if you specify ``ulps`` but neither of the other tolerances, only
+    ``ulps`` is considered.  If you specify it along with ``rel`` or ``abs``,
+    the numbers will be considered equal if any tolerance is met::
+
+        assert 1.0 + 2e-16 == approx(1.0, ulps=1)
+        assert 1.0 + 5e-16 != approx(1.0, ulps=1)
+
+    __ https://en.wikipedia.org/wiki/Unit_in_the_last_place
+
     If you're thinking about using ``approx``, then you might want to know how
     it compares to other good ways of comparing floating-point numbers.  All of
     these algorithms are based on relative and absolute tolerances and should
@@ -117,40 +152,249 @@ class approx(object):
       relative tolerance, only the absolute tolerance is considered.
     """
 
-    def __init__(self, expected, rel=None, abs=None):
-        self.expected = expected
-        self.abs = abs
-        self.rel = rel
+    # Tell numpy not to broadcast comparisons against approx objects, so that
+    # ``array == approx(...)`` calls our __eq__() with the whole array rather
+    # than once for each element.
+    __array_ufunc__ = None
+    __array_priority__ = 100
+
+    def __init__(self, expected, rel=None, abs=None, ulps=None, dtype=None,
+            threads=None):
+        self._expected = expected
+        self._rel = rel
+        self._abs = abs
+        self._ulps = _check_ulps(ulps)
+        self._dtype = dtype
+        self._threads = threads
+        self._scalars = None
+        self._array = _NOT_COMPILED
+        self._nested = None
+
+        # Compile the expected values and their tolerances once, so that
+        # nothing has to be rebuilt or revalidated each time this object is
+        # compared against something.  Nested structures are compiled level
+        # by level.  Arrays and flat sequences of numbers are compiled into
+        # arrays of tolerances that numpy can use directly.  Everything else
+        # (or everything, if numpy isn't installed) is compiled into a tuple
+        # of ApproxNonIterable objects, but only once it's first needed.
+        # Setting up numpy costs more than it saves for short sequences, so
+        # those are compiled the same way.
+        if isinstance(expected, (list, tuple)) and \
+                len(expected) >= _NUMPY_MIN_SIZE:
+            # Checking the type of every item in python is slow for long
+            # lists, so let numpy decide whether the list is flat first.
+            array = self._compiled_array()
+            if array is not None and array.shape == (len(expected),):
+                return
+            self._array = _NOT_COMPILED
+        if _is_nested(expected):
+            self._nested = _ApproxNested(
+                    expected, rel=rel, abs=abs, ulps=ulps, threads=threads)
+            return
+        if _is_array_like(expected, dtype):
+            self._compiled_array()
 
     def __repr__(self):
-        return ', '.join(repr(x) for x in self.expected)
+        if self._nested is not None:
+            return repr(self._nested)
+
+        # Only show the first and last few values of large arrays, and only
+        # compile the values that are actually shown.
+        size = self._size()
+        n = _REPR_MAX_ITEMS // 2
+
+        if size <= _REPR_MAX_ITEMS:
+            items = [repr(self._scalar(i)) for i in range(size)]
+        else:
+            items = [repr(self._scalar(i)) for i in range(n)] + ['...'] + \
+                    [repr(self._scalar(i)) for i in range(size - n, size)]
+
+        return ', '.join(items)
 
     def __eq__(self, actual):
-        from collections import Iterable
-        if not isinstance(actual, Iterable):
-            actual = [actual]
-        if len(actual) != len(self.expected):
-            return False
-        return all(a == x for a, x in zip(actual, self.expected))
+        from collections.abc import Iterable, Sized
+
+        # Nested structures (e.g. dictionaries) are compared level by level,
+        # by the object compiled for them in the constructor.
+        if self._nested is not None:
+            return self._nested == actual
+
+        # Iterables without a length (e.g. generators) are compared one chunk
+        # at a time, so they never have to be held in memory all at once.
+        # Checking against the abstract base classes is relatively slow, so
+        # skip it for the most common types.
+        if not isinstance(actual, (list, tuple) + _BUILTIN_NUMBERS) and \
+                isinstance(actual, Iterable) and not isinstance(actual, Sized):
+            return self._stream_eq(actual)
+
+        return self._compare(actual)
 
     def __ne__(self, actual):
         return not (actual == self)
 
+    def report(self, actual, max_mismatches=10):
+        """
+        Describe how the given actual values differ from the expected ones.
+
+        Every value is compared in a single pass (using numpy, if possible),
+        and the returned ``ApproxReport`` gives the number of mismatches, the
+        first few mismatches, and the largest absolute and relative errors.
+        Unlike ``repr()``, the report stays the same size no matter how many
+        values are compared.  Invalid tolerances are reported as mismatches
+        (with a NaN tolerance) rather than raising a ValueError.
+        """
+        from collections.abc import Iterable, Sized
+        from itertools import islice
+
+        self._require_flat('report()')
+        report = ApproxReport(self._size(), max_mismatches)
+
+        if isinstance(actual, Iterable) and not isinstance(actual, Sized):
+            actual = iter(actual)
+            chunks = iter(lambda: list(islice(actual, _STREAM_CHUNK_SIZE)), [])
+        elif isinstance(actual, Iterable) or _is_array_like(actual, self._dtype):
+            chunks = [actual]
+        else:
+            chunks = [[actual]]
+
+        start = 0
+        for chunk in chunks:
+            start += self._report_chunk(report, chunk, start)
+
+        return report
+
     @property
     def expected(self):
         # Regardless of whether the user-specified expected value is a number
-        # or a sequence of numbers, return a list of ApproxNonIterable objects
-        # that can be compared against.
-        from collections import Iterable
-        approx_non_iter = lambda x: ApproxNonIterable(x, self.rel, self.abs)
+        # or a sequence of numbers, return a tuple of ApproxNonIterable
+        # objects that can be compared against.  For arrays, this tuple is
+        # only built if it's actually needed (e.g. by repr()).
+        self._require_flat('expected')
+        if self._scalars is None:
+            self._scalars = self._compile_scalars()
+        return self._scalars
+
+    @property
+    def rel(self):
+        return self._rel
+
+    @property
+    def abs(self):
+        return self._abs
+
+    @property
+    def ulps(self):
+        return self._ulps
+
+    def _compile_scalars(self):
+        from collections.abc import Iterable
+        approx_non_iter = lambda x: ApproxNonIterable(
+                x, self._rel, self._abs, self._ulps)
+        if isinstance(self._expected, (list, tuple)):
+            return tuple(approx_non_iter(x) for x in self._expected)
+        if self._array not in (None, _NOT_COMPILED):
+            return tuple(approx_non_iter(x) for x in self._array.flat)
         if isinstance(self._expected, Iterable):
-            return [approx_non_iter(x) for x in self._expected]
+            return tuple(approx_non_iter(x) for x in self._expected)
         else:
-            return [approx_non_iter(self._expected)]
+            return (approx_non_iter(self._expected),)
 
-    @expected.setter
-    def expected(self, expected):
-        self._expected = expected
+    def _compare(self, actual, start=None, stop=None):
+        # Compare the given actual values against the expected values, or
+        # against a slice of the expected values if indices are given.
+        from collections.abc import Iterable
+
+        # If either side is a numpy array (or some other buffer of numbers),
+        # make the whole comparison with a handful of vectorized operations
+        # rather than one python-level comparison per element.
+        if self._array is not None and (
+                self._array is not _NOT_COMPILED or
+                _is_array_like(actual, self._dtype)):
+            array = self._compiled_array()
+            if array is not None:
+                result = array.compare(actual, start, stop, self._dtype)
+                if result is not None:
+                    return result
+
+        expected = self.expected[start:stop]
+        if not isinstance(actual, Iterable):
+            actual = [actual]
+        if len(actual) != len(expected):
+            return False
+        return all(a == x for a, x in zip(actual, expected))
+
+    def _stream_eq(self, actual, chunk_size=None):
+        from itertools import islice
+
+        chunk_size = chunk_size or _STREAM_CHUNK_SIZE
+        actual = iter(actual)
+
+        # Use numpy to compare each chunk, if possible.
+        array = self._compiled_array()
+        size = array.size if array is not None else len(self.expected)
+
+        for start in range(0, size, chunk_size):
+            stop = min(start + chunk_size, size)
+            chunk = list(islice(actual, stop - start))
+            if not self._compare(chunk, start, stop):
+                return False
+
+        return next(actual, _EXHAUSTED) is _EXHAUSTED
+
+    def _report_chunk(self, report, actual, start):
+        # Add the given chunk of actual values (which starts at the given
+        # index) to the report, and return the number of actual values.
+        array = self._compiled_array()
+        size = self._size()
+
+        if array is not None:
+            actual_array = _as_numeric_array(actual, self._dtype)
+            if actual_array is not None and _is_exact_as_float(actual_array):
+                # Values beyond the end of the expected values are only
+                # counted, not compared.
+                actual_array = actual_array.reshape(-1)
+                if start < size:
+                    stop = min(start + actual_array.size, size)
+                    array.report(report, actual_array[:stop - start], start)
+                report.actual_size += actual_array.size
+                return actual_array.size
+
+        actual = list(actual)
+        for i, a in enumerate(actual[:max(size - start, 0)], start):
+            report._add_scalar(i, a, self._scalar(i))
+        report.actual_size += len(actual)
+        return len(actual)
+
+    def _require_flat(self, name):
+        # Nested structures don't have a flat sequence of expected values
+        # (and their mismatches don't have a flat index to report), so don't
+        # pretend that they do.
+        if self._nested is not None:
+            raise TypeError("{} isn't supported for nested expected values: {!r}".format(
+                    name, self._expected))
+
+    def _size(self):
+        self._require_flat('_size()')
+        array = self._compiled_array() if self._scalars is None else None
+        return array.size if array is not None else len(self.expected)
+
+    def _scalar(self, i):
+        # Return the i-th expected value as an ApproxNonIterable, without
+        # compiling every other value if we can avoid it.
+        if self._scalars is None and self._array not in (None, _NOT_COMPILED):
+            x = self._expected[i] if isinstance(self._expected, (list, tuple)) \
+                    else self._array.flat[i]
+            return ApproxNonIterable(x, self._rel, self._abs, self._ulps)
+        return self.expected[i]
+
+    def _compiled_array(self):
+        # Only try to compile the array once, even if it turns out that the
+        # expected values can't be handled by numpy.
+        if self._array is _NOT_COMPILED:
+            self._array = _ApproxArray.compile(
+                    self._expected, self._rel, self._abs, self._ulps,
+                    self._dtype, self._threads)
+        return self._array
 
 
 class ApproxNonIterable(object):
@@ -166,10 +410,17 @@ class ApproxNonIterable(object):
     used within ``approx``.
     """
 
-    def __init__(self, expected, rel=None, abs=None):
-        self.expected = expected
-        self.abs = abs
-        self.rel = rel
+    def __init__(self, expected, rel=None, abs=None, ulps=None):
+        self._expected = expected
+        self._rel = rel
+        self._abs = abs
+        self._ulps = _check_ulps(ulps)
+
+        # The tolerance is calculated the first time it's needed, and then 
+        # remembered.  Most comparisons in tests are exact, so this avoids 
+        # calculating tolerances that are never used.
+        self._tolerance = None
+        self._tolerance_error = None
 
     def __repr__(self):
         # Infinities aren't compared using tolerances, so don't show a
@@ -184,7 +435,15 @@ class ApproxNonIterable(object):
         except ValueError:
             vetted_tolerance = '???'
 
-        plus_minus = u'{0} \u00b1 {1}'.format(self.expected, vetted_tolerance)
+        if self.ulps is None:
+            plus_minus = u'{0} \u00b1 {1}'.format(
+                    self.expected, vetted_tolerance)
+        elif self._ulps_only:
+            plus_minus = u'{0} \u00b1 {1} ulps'.format(
+                    self.expected, self.ulps)
+        else:
+            plus_minus = u'{0} \u00b1 {1} or {2} ulps'.format(
+                    self.expected, vetted_tolerance, self.ulps)
 
         # In python2, __repr__() must return a string (i.e. not a unicode
         # object).  In python3, __repr__() must return a unicode object
@@ -209,14 +468,59 @@ class ApproxNonIterable(object):
         if math.isinf(abs(self.expected)):
             return False
 
+        # Return true if the two numbers are within the given number of ULPs.
+        # This is checked before the other tolerances, so that invalid
+        # tolerances aren't an error if they aren't needed.
+        if self.ulps is not None:
+            if _ulp_distance(actual, self.expected) <= self.ulps:
+                return True
+            if self._ulps_only:
+                return False
+
         # Return true if the two numbers are within the tolerance.
         return abs(self.expected - actual) <= self.tolerance
 
     def __ne__(self, actual):
         return not (actual == self)
 
+    @property
+    def expected(self):
+        return self._expected
+
+    @property
+    def rel(self):
+        return self._rel
+
+    @property
+    def abs(self):
+        return self._abs
+
+    @property
+    def ulps(self):
+        return self._ulps
+
+    @property
+    def _ulps_only(self):
+        return self._ulps is not None and self._rel is None and self._abs is None
+
     @property
     def tolerance(self):
+        # If the tolerance can't be calculated, hold onto the error and raise 
+        # it every time the tolerance is needed.  That way the object can 
+        # still be created (and printed), infinities can still be compared, 
+        # and integers too big to convert to floats can still be exactly 
+        # equal.
+        if self._tolerance is None and self._tolerance_error is None:
+            try:
+                self._tolerance = self._calculate_tolerance()
+            except (ValueError, TypeError, ArithmeticError) as error:
+                self._tolerance_error = error
+
+        if self._tolerance_error is not None:
+            raise self._tolerance_error.with_traceback(None)
+        return self._tolerance
+
+    def _calculate_tolerance(self):
         set_default = lambda x, default: x if x is not None else default
 
         # Figure out what the absolute tolerance should be.  ``self.abs`` is
@@ -250,3 +554,940 @@ class ApproxNonIterable(object):
         return max(relative_tolerance, absolute_tolerance)
 
 
+def approx_stream(actual, expected, rel=None, abs=None, ulps=None,
+        chunk_size=None):
+    """
+    Compare two iterables of numbers (e.g. generators) one chunk at a time.
+
+    Neither iterable needs to have a length, and no more than one chunk of
+    each is ever held in memory, so this can be used to compare sequences that
+    are too big to fit in memory (e.g. data streamed from disk).  The
+    comparison stops as soon as a mismatch or a difference in length is found.
+    The tolerances are the same as for ``approx``, which is used to compare
+    each chunk::
+
+        >>> approx_stream((x / 10 for x in range(3)), [0.0, 0.1, 0.2])
+        True
+        >>> approx_stream((x / 10 for x in range(3)), [0.0, 0.1])
+        False
+    """
+    from itertools import islice
+
+    chunk_size = chunk_size or _STREAM_CHUNK_SIZE
+    actual, expected = iter(actual), iter(expected)
+
+    while True:
+        expected_chunk = list(islice(expected, chunk_size))
+        if not expected_chunk:
+            return next(actual, _EXHAUSTED) is _EXHAUSTED
+
+        # Use numpy to compare each chunk, if possible.
+        array = _as_numeric_array(expected_chunk)
+        if array is not None:
+            expected_chunk = array
+
+        actual_chunk = list(islice(actual, len(expected_chunk)))
+        if actual_chunk != approx(expected_chunk, rel, abs, ulps):
+            return False
+
+
+class ApproxReport(object):
+    """
+    A summary of the differences between some actual values and the expected
+    values of an ``approx`` object.  Create these objects with
+    ``approx.report()``.
+
+    The ``mismatch_count`` attribute is the total number of values that
+    aren't approximately equal, and ``mismatches`` is a list of the first
+    few of them.  Each mismatch is an ``ApproxMismatch`` tuple with ``index``,
+    ``actual``, ``expected`` and ``tolerance`` fields.  ``max_abs_error`` and
+    ``max_rel_error`` are the largest absolute and relative differences among
+    all the values that were compared (NaNs are ignored).  The ``ok``
+    property is true if the comparison succeeded.
+    """
+
+    def __init__(self, expected_size, max_mismatches=10):
+        self.expected_size = expected_size
+        self.actual_size = 0
+        self.mismatch_count = 0
+        self.mismatches = []
+        self.max_mismatches = max_mismatches
+        self.max_abs_error = 0.0
+        self.max_rel_error = 0.0
+
+    def __repr__(self):
+        lines = ['{} of {} values differ (max abs error: {:.1e}, max rel error: {:.1e})'.format(
+                self.mismatch_count, self.expected_size,
+                self.max_abs_error, self.max_rel_error)]
+
+        if self.actual_size != self.expected_size:
+            lines.append('expected {} values, got {}'.format(
+                self.expected_size, self.actual_size))
+
+        for mismatch in self.mismatches:
+            lines.append(u'[{}] {!r} != {!r} \u00b1 {:.1e}'.format(*mismatch))
+
+        hidden = self.mismatch_count - len(self.mismatches)
+        if hidden:
+            lines.append('... and {} more'.format(hidden))
+
+        return '\n'.join(lines)
+
+    @property
+    def ok(self):
+        return self.mismatch_count == 0 and \
+                self.actual_size == self.expected_size
+
+    def _add_scalar(self, index, actual, expected):
+        # Add a single comparison, between an actual value and an
+        # ApproxNonIterable object, to the report.
+        try:
+            tolerance = expected.tolerance
+        except ValueError:
+            tolerance = float('nan')
+
+        try:
+            equal = (actual == expected)
+        except ValueError:
+            equal = False
+
+        abs_error = abs(expected.expected - actual)
+        if abs_error == abs_error:
+            self.max_abs_error = max(self.max_abs_error, abs_error)
+            if abs_error:
+                rel_error = abs_error / abs(expected.expected) \
+                        if expected.expected else float('inf')
+                self.max_rel_error = max(self.max_rel_error, rel_error)
+
+        if not equal:
+            self.mismatch_count += 1
+            if len(self.mismatches) < self.max_mismatches:
+                self.mismatches.append(ApproxMismatch(
+                    index, actual, expected.expected, tolerance))
+
+
+class ApproxMismatch(
+        collections.namedtuple('ApproxMismatch',
+            'index actual expected tolerance')):
+    """
+    A single pair of values that weren't approximately equal, as described by
+    ``ApproxReport``.
+    """
+    __slots__ = ()
+
+
+class ApproxIndex(object):
+    """
+    Quickly find which of many stored numbers are approximately equal to a
+    query.
+
+    The stored value ``x`` matches the query ``q`` if ``x == approx(q, rel,
+    abs)``.  In other words, the tolerance is calculated with respect to the
+    query, using exactly the same rules as ``approx``.  Instead of comparing
+    the query to every stored value, the stored values are kept sorted and
+    the values within tolerance are found by binary search, so each query
+    takes O(log n) time.  Matches are returned as arrays of indices into the
+    stored values, in the order they were inserted::
+
+        >>> index = ApproxIndex([1.0, 2.0, 1.0 + 1e-9, 3.0])
+        >>> index.find(1.0)
+        array([0, 2])
+
+    Only real numbers can be indexed, because complex numbers can't be
+    sorted.  numpy is required.
+    """
+
+    def __init__(self, values=(), rel=None, abs=None):
+        import numpy as np
+
+        self.rel = rel
+        self.abs = abs
+        self._chunks = []
+        self._values = np.empty(0)
+        self._sorted = None
+        self._order = None
+        self.insert(values)
+
+    def __len__(self):
+        return self.values.size
+
+    @property
+    def values(self):
+        """
+        All the stored values, in the order they were inserted.
+        """
+        import numpy as np
+
+        if self._chunks:
+            self._values = np.concatenate([self._values] + self._chunks)
+            self._chunks = []
+
+        return self._values
+
+    def insert(self, values):
+        """
+        Add the given values (a number or an iterable of numbers) to the
+        index.  The values aren't sorted until the next query, so inserting
+        many values at once (or many times in a row) is cheap.
+        """
+        import numpy as np
+
+        values = np.atleast_1d(np.asarray(values)).reshape(-1)
+
+        if values.dtype.kind == 'c':
+            raise TypeError("can't index complex numbers, because they can't be sorted.")
+        if values.size and values.dtype.kind not in 'biuf':
+            raise TypeError("can only index real numbers, not {}".format(values.dtype))
+
+        self._chunks.append(values.astype(np.float64))
+        self._sorted = self._order = None
+
+    def find(self, query):
+        """
+        Return the indices of the stored values that are approximately equal
+        to the given number.
+        """
+        return self.find_many([query])[0]
+
+    def find_many(self, queries):
+        """
+        Return a list with one array of matching indices for each of the
+        given queries.
+        """
+        import numpy as np
+
+        if len(queries) == 0:
+            return []
+
+        query_indices, value_indices = self.join(queries)
+        splits = np.searchsorted(query_indices, np.arange(1, len(queries)))
+        return np.split(value_indices, splits)
+
+    def join(self, queries):
+        """
+        Find every pair of query and stored value that are approximately
+        equal.
+
+        Return two arrays of the same length, the first giving indices into
+        the queries and the second giving indices into the stored values.  The
+        pairs are sorted by query index and then by stored value index.  The
+        whole join takes O((n + m) log n) time, plus the time needed to
+        produce the output.
+        """
+        import numpy as np
+
+        queries = np.atleast_1d(np.asarray(queries, dtype=np.float64))
+        queries = queries.reshape(-1)
+        values, order = self._sort()
+
+        tolerance, invalid = _array_tolerance(queries, self.rel, self.abs)
+        infinite = np.isinf(queries)
+
+        # A query with an invalid tolerance is an error, unless it's exactly
+        # equal to every stored value (because then the tolerance is never
+        # needed).  Infinite queries never need a tolerance.
+        for q in queries[invalid & ~infinite]:
+            if np.any(values != q):
+                ApproxNonIterable(q.item(), self.rel, self.abs).tolerance
+
+        # Find every stored value that could possibly be within tolerance.
+        # The bounds are padded a little to allow for rounding error; the
+        # exact comparison below weeds out anything that doesn't belong.
+        # NaNs are sorted to the end and never match anything.
+        eps = np.finfo(np.float64).eps
+        tiny = np.finfo(np.float64).tiny
+
+        with np.errstate(invalid='ignore', over='ignore'):
+            radius = np.where(infinite | invalid, 0.0, tolerance)
+            padding = 4 * eps * (np.absolute(queries) + radius) + tiny
+            padding[infinite] = 0.0
+            lower = np.searchsorted(values, queries - radius - padding, 'left')
+            upper = np.searchsorted(values, queries + radius + padding, 'right')
+
+        counts = np.maximum(upper - lower, 0)
+        query_indices = np.repeat(np.arange(queries.size), counts)
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(lower, counts) + \
+                np.arange(query_indices.size) - offsets
+
+        # Compare each candidate exactly, the same way approx would.
+        q = queries[query_indices]
+        x = values[positions]
+
+        with np.errstate(invalid='ignore', over='ignore'):
+            equal = (x == q)
+            within = np.absolute(q - x) <= tolerance[query_indices]
+
+        match = equal | (~equal & ~infinite[query_indices] & within)
+        query_indices = query_indices[match]
+        value_indices = order[positions[match]]
+
+        resort = np.lexsort((value_indices, query_indices))
+        return query_indices[resort], value_indices[resort]
+
+    def _sort(self):
+        import numpy as np
+
+        if self._sorted is None:
+            values = self.values
+            self._order = np.argsort(values, kind='stable')
+            self._sorted = values[self._order]
+
+        return self._sorted, self._order
+
+
+def _check_ulps(ulps):
+    if ulps is None:
+        return None
+    if ulps != ulps:
+        raise ValueError("ULP tolerance can't be NaN.")
+    if ulps < 0:
+        raise ValueError("ULP tolerance can't be negative: {}".format(ulps))
+    return ulps
+
+def _ulp_distance(a, b):
+    """
+    Return the number of representable floating-point numbers between the
+    two given numbers, or infinity if either number isn't finite.
+    """
+    import struct
+
+    if isinstance(a, complex) or isinstance(b, complex):
+        raise TypeError("ULP tolerances aren't defined for complex numbers.")
+
+    # Use numpy for numpy scalars, so that the ULPs are counted with the right
+    # precision (e.g. for float32).
+    if type(a).__module__ == 'numpy' or type(b).__module__ == 'numpy':
+        import numpy as np
+        a, b = np.atleast_1d(a), np.atleast_1d(b)
+        dtype = np.result_type(a, b)
+        if dtype.kind in 'biu':
+            dtype = np.dtype(np.float64)
+        return _array_ulp_distance(a.astype(dtype), b.astype(dtype)).item()
+
+    a, b = float(a), float(b)
+    if math.isinf(a) or math.isinf(b) or math.isnan(a) or math.isnan(b):
+        return float('inf')
+
+    def ordered_bits(x):
+        # Interpret the bits of the float as an integer, flipping the order
+        # of the negative numbers, so that adjacent floats differ by one.
+        i = struct.unpack('<q', struct.pack('<d', x))[0]
+        return i if i >= 0 else -(i & 0x7fffffffffffffff)
+
+    return abs(ordered_bits(a) - ordered_bits(b))
+
+def _array_ulp_distance(a, b):
+    """
+    Return the number of representable floating-point numbers between the
+    corresponding elements of two arrays of the same floating-point dtype.
+    The distance is infinite wherever either element isn't finite.
+    """
+    import numpy as np
+
+    if a.dtype.kind == 'c' or b.dtype.kind == 'c':
+        raise TypeError("ULP tolerances aren't defined for complex numbers.")
+    if a.dtype.itemsize not in (2, 4, 8):
+        raise TypeError("ULP tolerances aren't supported for {} numbers.".format(a.dtype))
+
+    bits = a.dtype.itemsize * 8
+    signed = np.dtype('i{}'.format(a.dtype.itemsize))
+    unsigned = np.dtype('u{}'.format(a.dtype.itemsize))
+    magnitude = signed.type((1 << (bits - 1)) - 1)
+    sign = unsigned.type(1 << (bits - 1))
+
+    def ordered_bits(x):
+        # Reinterpret the floats as integers, flip the order of the negative
+        # numbers so that adjacent floats differ by one, then shift everything
+        # into the unsigned range so the subtraction below can't overflow.
+        i = np.ascontiguousarray(x).view(signed)
+        i = np.where(i >= 0, i, -(i & magnitude))
+        return i.view(unsigned) ^ sign
+
+    ia, ib = ordered_bits(a), ordered_bits(b)
+    distance = np.where(ia >= ib, ia - ib, ib - ia).astype(np.float64)
+    distance[~(np.isfinite(a) & np.isfinite(b))] = np.inf
+
+    return distance
+
+
+class _ApproxNested(object):
+    """
+    A compiled form of a nested structure of expected values, e.g. a
+    dictionary, a list of lists, a dataclass, or a numpy structured array.
+
+    The structure is compared one level at a time.  At each level, all of
+    the numbers are compared at once (using numpy, if possible), then each of
+    the nested containers is compared recursively.  The comparison stops at
+    the first mismatch.  Flat sequences and arrays of numbers are compared
+    using ``approx``, and anything that isn't a number or a container is
+    compared exactly.
+    """
+
+    __array_ufunc__ = None
+    __array_priority__ = 100
+
+    def __init__(self, expected, **kwargs):
+        import dataclasses
+        from collections.abc import Mapping
+
+        if isinstance(expected, Mapping):
+            self.kind = 'mapping'
+            items = list(expected.items())
+        elif _is_dataclass_instance(expected):
+            self.kind = 'dataclass'
+            items = [(f.name, getattr(expected, f.name))
+                     for f in dataclasses.fields(expected)]
+        elif _is_structured_array(expected):
+            self.kind = 'record'
+            items = [(name, expected[name]) for name in expected.dtype.names]
+        else:
+            self.kind = 'sequence'
+            items = list(enumerate(expected))
+
+        self.expected = expected
+        self.keys = [key for key, value in items]
+        self.number_keys = []
+        self.children = []
+
+        numbers = []
+        for key, value in items:
+            if _is_number(value):
+                self.number_keys.append(key)
+                numbers.append(value)
+            elif _is_nested(value):
+                self.children.append((key, _ApproxNested(value, **kwargs)))
+            elif _is_array_like(value) and _as_numeric_array(value) is None:
+                self.children.append((key, _Exactly(value)))
+            elif _is_array_like(value) or isinstance(value, (list, tuple)):
+                self.children.append((key, approx(value, **kwargs)))
+            else:
+                self.children.append((key, _Exactly(value)))
+
+        array = _as_numeric_array(numbers) if numbers else None
+        self.numbers = approx(array if array is not None else numbers, **kwargs)
+
+    def __repr__(self):
+        reprs = {key: repr(self.numbers._scalar(i))
+                 for i, key in enumerate(self.number_keys)}
+        reprs.update((key, repr(child)) for key, child in self.children)
+
+        if self.kind == 'mapping':
+            items = ['{!r}: {}'.format(k, reprs[k]) for k in self.keys]
+            return '{' + ', '.join(items) + '}'
+        if self.kind == 'dataclass' or self.kind == 'record':
+            items = ['{}={}'.format(k, reprs[k]) for k in self.keys]
+            name = type(self.expected).__name__
+            return '{}({})'.format(name, ', '.join(items))
+        else:
+            items = [reprs[k] for k in self.keys]
+            return '[' + ', '.join(items) + ']'
+
+    def __eq__(self, actual):
+        get = self._getter(actual)
+        if get is None:
+            return False
+
+        try:
+            numbers = [get(key) for key in self.number_keys]
+        except (KeyError, IndexError, AttributeError, ValueError):
+            return False
+
+        if numbers and numbers != self.numbers:
+            return False
+
+        for key, child in self.children:
+            try:
+                value = get(key)
+            except (KeyError, IndexError, AttributeError, ValueError):
+                return False
+            if not child == value:
+                return False
+
+        return True
+
+    def __ne__(self, actual):
+        return not (actual == self)
+
+    def _getter(self, actual):
+        # Return a function that gets values from the actual structure, or
+        # None if the actual structure doesn't have the same shape as the
+        # expected one.
+        from collections.abc import Mapping
+
+        if self.kind == 'mapping':
+            if not isinstance(actual, Mapping):
+                return None
+            if set(actual.keys()) != set(self.keys):
+                return None
+            return actual.__getitem__
+
+        if self.kind == 'dataclass':
+            # Dataclasses are only equal to instances of the same class.
+            if type(actual) is not type(self.expected):
+                return None
+            return lambda key: getattr(actual, key)
+
+        if self.kind == 'record':
+            if not _is_structured_array(actual):
+                return None
+            if actual.dtype.names != self.expected.dtype.names:
+                return None
+            if actual.shape != self.expected.shape:
+                return None
+            return actual.__getitem__
+
+        if isinstance(actual, (str, bytes, Mapping)):
+            return None
+        try:
+            if len(actual) != len(self.keys):
+                return None
+        except TypeError:
+            return None
+        return actual.__getitem__
+
+
+class _Exactly(object):
+    """
+    Compare a value that isn't a number or a container (or an array of things
+    that aren't numbers, e.g. strings) exactly.
+    """
+
+    __array_ufunc__ = None
+    __array_priority__ = 100
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def __repr__(self):
+        return repr(self.expected)
+
+    def __eq__(self, actual):
+        shape = getattr(self.expected, 'shape', None)
+        if shape is not None and getattr(actual, 'shape', None) != shape:
+            return False
+
+        result = (self.expected == actual)
+        if hasattr(result, 'all'):
+            result = result.all()
+        return bool(result)
+
+
+def _is_number(x):
+    import numbers
+    return isinstance(x, _BUILTIN_NUMBERS) or isinstance(x, numbers.Number)
+
+def _is_dataclass_instance(x):
+    import dataclasses
+    return dataclasses.is_dataclass(x) and not isinstance(x, type)
+
+def _is_structured_array(x):
+    return bool(getattr(getattr(x, 'dtype', None), 'names', None))
+
+def _is_nested(x):
+    """
+    Return true if the given object is a container that needs to be compared
+    recursively, rather than as a flat sequence of numbers.
+    """
+    from collections.abc import Mapping
+
+    if isinstance(x, _BUILTIN_NUMBERS):
+        return False
+    if isinstance(x, Mapping):
+        return True
+    if _is_dataclass_instance(x) or _is_structured_array(x):
+        return True
+    if isinstance(x, (list, tuple)):
+        return not all(_is_number(item) for item in x)
+    return False
+
+
+_STREAM_CHUNK_SIZE = 65536
+_NUMPY_MIN_SIZE = 32
+_BUILTIN_NUMBERS = int, float, complex
+_REPR_MAX_ITEMS = 10
+_COMPARE_CHUNK_SIZE = 65536
+_NOT_COMPILED = object()
+_EXHAUSTED = object()
+
+def _is_array_like(x, dtype=None):
+    """
+    Return true if the given object is a numpy array or exposes the buffer
+    protocol, i.e. if it's worth trying to compare it using numpy.  If a dtype
+    is given, file paths and raw bytes also count.
+    """
+    if dtype is not None and isinstance(x, (str, bytes, os.PathLike)):
+        return True
+    if isinstance(x, (str, bytes, list, tuple) + _BUILTIN_NUMBERS):
+        return False
+    if type(x).__module__ == 'numpy':
+        return True
+    try:
+        memoryview(x)
+    except TypeError:
+        return False
+    return True
+
+def _is_untyped_buffer(x):
+    """
+    Return true if the given object is a buffer of raw bytes (e.g. an mmap or
+    a bytearray), which only means something once it's given a dtype.
+    """
+    if type(x).__module__ == 'numpy':
+        return False
+    try:
+        return memoryview(x).format in ('B', 'b', 'c')
+    except TypeError:
+        return False
+
+def _is_external_buffer(x):
+    """
+    Return true if the given object is a file path or a buffer that isn't
+    owned by numpy (e.g. a memory-mapped file, a memoryview, or an
+    array.array).  The contents of these buffers shouldn't be copied, because
+    they might be huge.
+    """
+    import numpy as np
+
+    if isinstance(x, (str, os.PathLike, np.memmap)):
+        return True
+    if isinstance(x, np.ndarray):
+        return False
+    try:
+        memoryview(x)
+    except TypeError:
+        return False
+    return True
+
+def _as_numeric_array(x, dtype=None):
+    """
+    Convert the given object into a 1D numpy array of numbers, or return None
+    if that isn't possible (e.g. if numpy isn't installed or the object
+    contains something like a Decimal or a Fraction).
+
+    Buffers are wrapped without being copied.  If a dtype is given, file paths
+    are memory-mapped and raw bytes are reinterpreted as that dtype, also
+    without being copied.  In this case, numpy is required.
+    """
+    if dtype is not None:
+        import numpy as np
+
+        if isinstance(x, (str, os.PathLike)):
+            if os.path.getsize(x) == 0:
+                return np.empty(0, dtype=dtype)
+            return np.memmap(x, dtype=dtype, mode='r')
+
+        if _is_untyped_buffer(x):
+            return np.frombuffer(x, dtype=dtype)
+
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+
+    try:
+        array = np.atleast_1d(np.asarray(x))
+    except (TypeError, ValueError):
+        return None
+
+    if array.dtype.kind not in 'biufc':
+        return None
+
+    return array
+
+def _is_exact_as_float(array):
+    """
+    Return true if every value in the given numpy array can be converted to a
+    float64 without losing precision.  This is only a concern for 64-bit
+    integers with magnitudes beyond 2**53, which have to be compared one at a
+    time to get the same (exact) results as python integers.
+    """
+    if array.dtype.kind not in 'iu' or array.dtype.itemsize < 8 or not array.size:
+        return True
+    return array.max() <= 2**53 and array.min() >= -2**53
+
+class _ApproxArray(object):
+    """
+    A compiled form of an array of expected values, which can be compared
+    against arrays of actual values using the same rules as
+    ``ApproxNonIterable.__eq__()``, but without any python-level loops.
+
+    Comparisons are made one chunk at a time, so they can stop early and so
+    the temporary arrays they need don't scale with the size of the input.
+    The tolerance of every expected value is calculated and validated once,
+    when the object is created, unless the expected values live in an
+    external buffer (e.g. a memory-mapped file).  In that case the tolerances
+    are calculated one chunk at a time, so that nothing the size of the buffer
+    is ever allocated.  Use ``_ApproxArray.compile()`` to create these
+    objects; it returns None if numpy can't handle the expected values.
+    """
+
+    def __init__(self, expected, rel=None, abs=None, ulps=None,
+            precompute=True, threads=None):
+        self.expected = expected
+        self.shape = expected.shape
+        self.flat = expected.reshape(-1)
+        self.rel = rel
+        self.abs = abs
+        self.ulps = ulps
+        self.ulps_only = ulps is not None and rel is None and abs is None
+        self.threads = os.cpu_count() if threads is True else threads
+        self._precomputed = None
+
+        if precompute:
+            self._precomputed = self._calculate(self.flat)
+            for array in self._precomputed:
+                array.setflags(write=False)
+
+    @classmethod
+    def compile(cls, expected, rel=None, abs=None, ulps=None, dtype=None,
+            threads=None):
+        array = _as_numeric_array(expected, dtype)
+        if array is None or not _is_exact_as_float(array):
+            return None
+        precompute = not _is_external_buffer(expected)
+        return cls(array, rel, abs, ulps, precompute, threads)
+
+    @property
+    def size(self):
+        return self.flat.size
+
+    def compare(self, actual, start=None, stop=None, dtype=None):
+        """
+        Return true if every actual value is within tolerance of the
+        corresponding expected value.  If indices are given, compare against
+        that slice of the (flattened) expected values.  Return None if the
+        actual values can't be handled by numpy, in which case the caller
+        should fall back on the scalar comparison.
+        """
+        # Raw bytes (or files) that don't hold a whole number of values can't
+        # be equal to anything.
+        try:
+            actual = _as_numeric_array(actual, dtype)
+        except ValueError:
+            return False
+
+        if actual is None or not _is_exact_as_float(actual):
+            return None
+
+        if start is None and stop is None:
+            if actual.shape != self.shape:
+                return False
+            start, stop = 0, self.size
+        elif actual.shape != (stop - start,):
+            return False
+
+        actual = actual.reshape(-1)
+
+        # Only bother with threads if each one will get several chunks.
+        num_chunks = (stop - start) // _COMPARE_CHUNK_SIZE
+        if self.threads and self.threads > 1 and num_chunks >= 2 * self.threads:
+            return self._compare_parallel(actual, start, stop)
+        else:
+            return self._compare_range(actual, start, start, stop)
+
+    def _compare_range(self, actual, offset, start, stop):
+        # Compare the expected values between the given indices against the
+        # corresponding actual values.  ``offset`` is the index of the expected
+        # value that corresponds to ``actual[0]``.
+        for i in range(start, stop, _COMPARE_CHUNK_SIZE):
+            j = min(i + _COMPARE_CHUNK_SIZE, stop)
+            chunk = actual[i - offset:j - offset]
+            bad = self._first_bad(chunk, *self._chunk(i, j))
+            if bad is not None:
+                return self._fail(i + bad[0], bad[1])
+
+        return True
+
+    def _compare_parallel(self, actual, start, stop):
+        # Split the array into one contiguous range per thread.  numpy
+        # releases the GIL while it works, so the threads really do run in
+        # parallel.  As soon as any thread finds a mismatch, the others stop.
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        failed = threading.Event()
+        step = -(-(stop - start) // self.threads)
+        ranges = [(i, min(i + step, stop)) for i in range(start, stop, step)]
+
+        def compare_range(bounds):
+            # Return the first mismatch (if any) and how far we got.
+            lo, hi = bounds
+            for i in range(lo, hi, _COMPARE_CHUNK_SIZE):
+                if failed.is_set():
+                    return None, i
+                j = min(i + _COMPARE_CHUNK_SIZE, hi)
+                chunk = actual[i - start:j - start]
+                bad = self._first_bad(chunk, *self._chunk(i, j))
+                if bad is not None:
+                    failed.set()
+                    return (i + bad[0], bad[1]), j
+            return None, hi
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            results = list(pool.map(compare_range, ranges))
+
+        if not failed.is_set():
+            return True
+
+        # Find the first mismatch, so that errors are raised exactly when the
+        # serial comparison would've raised them.  Any ranges that were cut
+        # short before that mismatch have to be finished first.
+        for (lo, hi), (bad, checked) in zip(ranges, results):
+            if bad is not None:
+                return self._fail(*bad)
+            if not self._compare_range(actual, start, checked, hi):
+                return False
+
+    def _calculate(self, expected):
+        import numpy as np
+
+        # Integer and boolean arrays can overflow (or refuse to subtract at
+        # all), so do the arithmetic with floats instead.  compile() makes
+        # sure that this conversion is exact.
+        if expected.dtype.kind in 'biu':
+            expected = expected.astype(np.float64)
+
+        tolerance, invalid = _array_tolerance(expected, self.rel, self.abs)
+
+        # If only ULPs are being considered, the other tolerances are never
+        # used, so it doesn't matter if they're invalid.
+        if self.ulps_only:
+            invalid = np.zeros_like(invalid)
+
+        # Infinite expected values are only equal to themselves.  The
+        # np.absolute() call is for compatibility with complex numbers.
+        infinite = np.isinf(np.absolute(expected))
+
+        return expected, tolerance, invalid, infinite
+
+    def _chunk(self, start, stop):
+        if self._precomputed is not None:
+            return tuple(x[start:stop] for x in self._precomputed)
+        else:
+            return self._calculate(self.flat[start:stop])
+
+    def report(self, report, actual, start=0):
+        """
+        Add every value in the given (flat) array of actual values to the
+        given ApproxReport, one chunk at a time.  The actual values are
+        compared against the expected values beginning at the given index.
+        """
+        import numpy as np
+
+        for i in range(start, start + actual.size, _COMPARE_CHUNK_SIZE):
+            j = min(i + _COMPARE_CHUNK_SIZE, start + actual.size)
+            chunk = actual[i - start:j - start]
+            expected, tolerance, invalid, infinite = self._chunk(i, j)
+            bad, error, abs_error = self._check_chunk(
+                    chunk, expected, tolerance, invalid, infinite)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rel_error = abs_error / np.absolute(expected)
+                rel_error[abs_error == 0] = 0
+
+            report.max_abs_error = max(report.max_abs_error,
+                    np.fmax.reduce(abs_error, initial=0.0).item())
+            report.max_rel_error = max(report.max_rel_error,
+                    np.fmax.reduce(rel_error, initial=0.0).item())
+            report.mismatch_count += int(np.count_nonzero(bad))
+
+            room = report.max_mismatches - len(report.mismatches)
+            for k in np.flatnonzero(bad)[:max(room, 0)]:
+                report.mismatches.append(ApproxMismatch(
+                    i + int(k),
+                    chunk[k].item(),
+                    expected[k].item(),
+                    float('nan') if invalid[k] else tolerance[k].item(),
+                ))
+
+    def _check_chunk(self, actual, expected, tolerance, invalid, infinite):
+        # Return a mask of the values that aren't approximately equal, a mask
+        # of the values with invalid tolerances (these are also "not equal"),
+        # and the absolute differences between the values.
+        import numpy as np
+
+        # compare() and report() make sure that this conversion is exact.
+        if actual.dtype.kind in 'biu':
+            actual = actual.astype(np.float64)
+
+        with np.errstate(invalid='ignore', over='ignore'):
+            close = (actual == expected)
+
+            # Values within the allowed number of ULPs are considered equal
+            # without looking at the other tolerances.  Don't count ULPs if
+            # every value is exactly equal, so that dtypes without a ULP
+            # distance (e.g. long doubles) can still be compared.
+            if self.ulps is not None and not close.all():
+                dtype = np.result_type(actual, expected)
+                ulps = _array_ulp_distance(
+                        actual.astype(dtype, copy=False),
+                        expected.astype(dtype, copy=False))
+                close |= (ulps <= self.ulps)
+
+            # A tolerance is only needed for values that aren't exactly
+            # equal and aren't infinite.
+            needs_tolerance = ~close & ~infinite
+            abs_error = np.absolute(expected - actual)
+            within = abs_error <= tolerance
+
+            if self.ulps_only:
+                within[...] = False
+
+        error = needs_tolerance & invalid
+        bad = ~(close | (needs_tolerance & within)) | error
+
+        return bad, error, abs_error
+
+    def _first_bad(self, actual, expected, tolerance, invalid, infinite):
+        # Return the index of the first value that isn't approximately equal
+        # (relative to the start of the chunk) and whether or not that value
+        # has an invalid tolerance.  Return None if every value is equal.
+        import numpy as np
+
+        bad, error, abs_error = self._check_chunk(
+                actual, expected, tolerance, invalid, infinite)
+
+        if not bad.any():
+            return None
+
+        i = int(np.argmax(bad))
+        return i, bool(error[i])
+
+    def _fail(self, index, error):
+        # The scalar comparison stops at the first element that isn't equal,
+        # so only raise an error if that element is the one with a bad
+        # tolerance.  Delegate to ApproxNonIterable so the error message is
+        # the same.
+        if error:
+            x = self.flat[index].item()
+            ApproxNonIterable(x, self.rel, self.abs, self.ulps).tolerance
+        return False
+
+def _array_tolerance(expected, rel=None, abs=None):
+    """
+    Return an array of tolerances for the given array of expected values, and
+    a boolean array indicating which of those tolerances are invalid (e.g.
+    negative or NaN).  The rules are the same as for
+    ``ApproxNonIterable.tolerance``.
+    """
+    import numpy as np
+
+    absolute_tolerance = float(abs if abs is not None else 1e-12)
+    absolute_invalid = \
+            absolute_tolerance < 0 or math.isnan(absolute_tolerance)
+
+    if rel is None and abs is not None:
+        tolerance = np.full(expected.shape, absolute_tolerance)
+        invalid = np.full(expected.shape, absolute_invalid)
+        return tolerance, invalid
+
+    relative_tolerance = float(rel if rel is not None else 1e-6)
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        relative_tolerance = relative_tolerance * np.absolute(expected)
+        invalid = absolute_invalid | \
+                (relative_tolerance < 0) | np.isnan(relative_tolerance)
+        tolerance = np.fmax(relative_tolerance, absolute_tolerance)
+
+    return tolerance, invalid
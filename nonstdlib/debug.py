@@ -5,8 +5,10 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import sys
+import time
 import logging
-import contextlib
+
+from .fmt import _compile_template
 
 def log_level(level):
     """
@@ -56,7 +58,15 @@ def config(stream=sys.stderr,
            format='%(levelname)s [%(name)s:%(lineno)s] %(message)s',
            file=None,
            file_level=None,
-           file_format=None):
+           file_format=None,
+           background=False,
+           queue_size=10000,
+           structured=False,
+           max_bytes=None,
+           rotate_interval=None,
+           compress=False,
+           multiprocess=False,
+           coalesce=None):
     """
     Configure logging to stream and file concurrently.
 
@@ -84,6 +94,57 @@ def config(stream=sys.stderr,
 
     file_format: str|None
         Overwrite format of logs for file. Will default to `format` if None.
+
+    background: bool
+        If true, don't write log messages from the thread that logged them.  
+        Instead, put them on a queue and write them (in batches) from a 
+        background thread, so that slow disks or terminals don't stall the 
+        calling code.  Any queued messages are written when the interpreter 
+        exits.
+
+    queue_size: int
+        The maximum number of messages that can be waiting to be written in 
+        background mode.  Messages logged while the queue is full are dropped, 
+        and the number of dropped messages is reported at exit.  If zero, the 
+        queue is unbounded.
+
+    structured: bool
+        If true, write each message as a line of JSON (see `_JsonFormatter`) 
+        instead of using `format` and `file_format`.  Writes to the log file 
+        are also buffered into large blocks.  The buffer is flushed when it 
+        fills up, within a second of any message being logged (even if 
+        nothing else is logged), whenever an error is logged, and when the 
+        interpreter exits.
+
+    max_bytes: int|None
+        In structured mode, start a new log file once the current one would 
+        grow beyond this size.  The old file is renamed with a timestamp.
+
+    rotate_interval: float|None
+        In structured mode, start a new log file once the current one has 
+        been open for this many seconds.
+
+    compress: bool
+        In structured mode, gzip old log files (in a background thread) after 
+        they're rotated.
+
+    multiprocess: bool
+        If true, child processes (either forked, or started by 
+        `multiprocessing` with any start method) send their log records to 
+        this process over a local socket, rather than writing them 
+        themselves.  This keeps the lines from different processes from 
+        interleaving in the same file.  Spawned children that configure 
+        logging before they start running, and children that call `config()` 
+        themselves, don't send their records to this process.  Other 
+        subprocesses (e.g. started with `subprocess`) aren't affected.
+
+    coalesce: float|None
+        If given, identical messages logged one after another from the same 
+        line (via the helpers in this module) are only written once.  A 
+        summary saying how many times the message was repeated is logged 
+        when a different message comes from that line, once this many 
+        seconds have passed since the message was written, or when the 
+        program exits, whichever comes first.
     """
     # It doesn't make sense to configure a logger with no handlers.
     assert file is not None or stream is not None
@@ -100,8 +161,40 @@ def config(stream=sys.stderr,
     else:
         file_level = log_level(file_level)
 
+    # Put back the handlers from any previous call in background mode, so 
+    # basicConfig() sees the real handlers rather than the queue.
+    _stop_background_logging()
+
+    # If this is a child process that's been sending its records to its 
+    # parent, stop.  Configuring logging explicitly takes precedence.
+    _disconnect_from_aggregator()
+
     # Everything falls to pieces if I don't use basicConfig.
-    if stream is not None:
+    if structured:
+        handlers = []
+
+        if stream is not None:
+            handler = logging.StreamHandler(stream)
+            handler.setLevel(stream_level)
+            handlers.append(handler)
+
+        if file is not None:
+            handler = _StructuredFileHandler(
+                    file,
+                    max_bytes=max_bytes,
+                    rotate_interval=rotate_interval,
+                    compress=compress,
+            )
+            handler.setLevel(file_level)
+            handlers.append(handler)
+
+        for handler in handlers:
+            handler.setFormatter(_JsonFormatter())
+
+        logging.basicConfig(handlers=handlers,
+                            level=min(x.level for x in handlers))
+
+    elif stream is not None:
         logging.basicConfig(stream=stream,
                             level=stream_level,
                             format=stream_format)
@@ -116,6 +209,699 @@ def config(stream=sys.stderr,
                             level=file_level,
                             format=file_format)
 
+    # Move all the handlers on the root logger behind a queue, if requested.
+    if background:
+        _start_background_logging(queue_size)
+
+    # Remember whether or not to coalesce repeated messages, and whether or 
+    # not the handlers need the values of the fields in each message.
+    global _coalesce, _record_fields
+    _coalesce = coalesce
+    _record_fields = structured
+
+    # Collect records from any child processes, if requested.
+    if multiprocess:
+        _start_aggregator()
+
+def _start_background_logging(queue_size):
+    """
+    Replace the handlers on the root logger with a single handler that puts 
+    records on a queue, and start a thread that passes those records on to 
+    the original handlers.
+    """
+    import queue, atexit
+    global _background_listener
+
+    root = logging.getLogger()
+    records = queue.Queue(queue_size)
+    listener = _BackgroundListener(records, root.handlers)
+
+    root.handlers = [_BackgroundHandler(records)]
+    listener.start()
+
+    if _background_listener is None:
+        import os
+        atexit.register(_stop_background_logging)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_fork_background_logging)
+
+    _background_listener = listener
+
+def _stop_background_logging():
+    """
+    Write any queued records, stop the background thread, and put the 
+    original handlers back on the root logger.
+    """
+    listener = _background_listener
+    if listener is None or not listener.is_alive():
+        return
+
+    root = logging.getLogger()
+    handler = next((
+        x for x in root.handlers
+        if isinstance(x, _BackgroundHandler) and x.queue is listener.queue),
+        None)
+
+    if handler is not None:
+        root.removeHandler(handler)
+
+    listener.stop()
+    root.handlers[:0] = listener.handlers
+
+    if handler is not None and handler.dropped:
+        sys.stderr.write(
+                "nonstdlib: dropped {} log record(s) because the background "
+                "queue was full.\n".format(handler.dropped))
+
+def _fork_background_logging():
+    """
+    Give the original handlers back to the root logger in a forked child.
+
+    The child inherits the handler that puts records on the queue, but not 
+    the thread that takes them off, so its records would otherwise be lost 
+    without a word.  The child handles its records in the foreground, rather 
+    than starting a thread of its own, because there's no guarantee that it 
+    would get a chance to empty the queue before exiting (multiprocessing 
+    workers, for example, exit without calling any atexit hooks).
+    """
+    global _background_listener
+    listener, _background_listener = _background_listener, None
+
+    if listener is None:
+        return
+
+    root = logging.getLogger()
+    for i, handler in enumerate(root.handlers):
+        if isinstance(handler, _BackgroundHandler) and \
+                handler.queue is listener.queue:
+            root.handlers[i:i+1] = listener.handlers
+            break
+
+class _BackgroundHandler(logging.Handler):
+    """
+    Put log records on a bounded queue without ever blocking.  Records that 
+    don't fit in the queue are counted and dropped.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        import queue
+
+        try:
+            self.queue.put_nowait(_prepare_record(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+def _prepare_record(record):
+    """
+    Return a copy of the given record that's safe to handle later or in 
+    another process.
+    
+    The arguments are merged into the message (and any traceback is 
+    rendered) right away, because the arguments might change, go out of 
+    scope, or not be picklable.
+    """
+    import copy
+
+    message = record.getMessage()
+    if record.exc_info:
+        message += '\n' + logging.Formatter().formatException(record.exc_info)
+
+    record = copy.copy(record)
+    record.message = message
+    record.msg = message
+    record.args = None
+    record.exc_info = None
+    record.exc_text = None
+    return record
+
+class _BackgroundListener:
+    """
+    Pass records from a queue to a set of handlers, from a background thread.
+
+    Records are taken from the queue in batches.  Stream handlers get each 
+    batch in a single write (followed by a single flush), rather than one 
+    write and one flush per record.
+    """
+    batch_size = 1000
+
+    def __init__(self, queue, handlers):
+        import threading
+
+        self.queue = queue
+        self.handlers = list(handlers)
+        self.thread = threading.Thread(
+                target=self._monitor, name='nonstdlib-logging', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def _monitor(self):
+        import queue
+
+        while True:
+            batch = [self.queue.get()]
+
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            done = batch[-1] is None
+            batch = [x for x in batch if x is not None]
+
+            for handler in self.handlers:
+                _handle_batch(handler, batch)
+
+            if done:
+                break
+
+def _handle_batch(handler, records):
+    records = [x for x in records if x.levelno >= handler.level]
+    if not records:
+        return
+
+    # Only write the batch in one go if the handler writes to its stream the 
+    # same way StreamHandler does.  Subclasses that override emit() (e.g. to 
+    # rotate files or add colors) have to handle each record themselves, as 
+    # do handlers that haven't opened their stream yet (e.g. a FileHandler 
+    # with delay=True).  FileHandler.emit() only differs from 
+    # StreamHandler.emit() in that it opens the stream if necessary.
+    stream = getattr(handler, 'stream', None)
+    if type(handler).emit not in _BATCHABLE_EMITS or stream is None:
+        for record in records:
+            handler.handle(record)
+        return
+
+    records = [x for x in records if handler.filter(x)]
+    if not records:
+        return
+
+    handler.acquire()
+    try:
+        stream.write(''.join(
+            handler.format(x) + handler.terminator for x in records))
+        handler.flush()
+    except Exception:
+        handler.handleError(records[-1])
+    finally:
+        handler.release()
+
+_BATCHABLE_EMITS = logging.StreamHandler.emit, logging.FileHandler.emit
+_background_listener = None
+
+class _JsonFormatter(logging.Formatter):
+    """
+    Format log records as single lines of JSON.
+
+    Each line has the time the message was logged (in seconds since the 
+    epoch), the name of the logger, the level, the file, line and function 
+    that logged the message, and the message itself.  Messages logged via 
+    this module also include the value of each field they refer to (e.g. 
+    'x.y[0]'), as "fields".  Values other than numbers, strings, booleans and 
+    None are included as their repr().
+    """
+
+    def format(self, record):
+        import json
+
+        data = {
+                'time': record.created,
+                'name': record.name,
+                'level': record.levelname,
+                'file': record.pathname,
+                'line': record.lineno,
+                'function': record.funcName,
+                'message': record.getMessage(),
+        }
+
+        fields = getattr(record, 'fields', None)
+        if fields:
+            data['fields'] = fields
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = record.stack_info
+
+        return json.dumps(data, default=repr)
+
+class _StructuredFileHandler(logging.Handler):
+    """
+    Write log messages to a file in large blocks, and start new files when 
+    the current one gets too big or too old.
+
+    Messages are written once the buffer fills up, when an error is logged, 
+    and no more than `flush_interval` seconds after they were logged (by a 
+    timer thread, so they still get written if nothing else is logged).
+
+    Rotated files are renamed by appending the time they were rotated, e.g. 
+    'log.jsonl' becomes 'log.jsonl.20180101-120000'.  If `compress` is true, 
+    they are then gzipped by a background thread.
+    """
+    buffer_size = 65536
+    flush_interval = 1.0
+
+    def __init__(self, path, max_bytes=None, rotate_interval=None,
+            compress=False):
+        import os
+
+        logging.Handler.__init__(self)
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.file = None
+        self.opened = None
+        self.buffer = []
+        self.buffered = 0
+        self.buffered_record = None
+        self.flush_timer = None
+        self.compressors = []
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + '\n'
+        except Exception:
+            self.handleError(record)
+            return
+
+        self.buffer.append(line)
+        self.buffered += len(line)
+        self.buffered_record = record
+
+        if self.buffered >= self.buffer_size or record.levelno >= logging.ERROR:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = _start_timer(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.acquire()
+        try:
+            timer, self.flush_timer = self.flush_timer, None
+            if timer is not None:
+                timer.cancel()
+
+            if not self.buffer:
+                return
+
+            lines = [x.encode('utf-8') for x in self.buffer]
+            record = self.buffered_record
+            self.buffer = []
+            self.buffered = 0
+            self.buffered_record = None
+
+            # Like the handlers in the standard library, report I/O errors 
+            # (e.g. a full disk or a deleted directory) via handleError() 
+            # rather than raising them into the code that logged the 
+            # message, or into the timer thread.  The buffered messages are 
+            # lost, but the file is opened again by the next flush.
+            try:
+                self._write(lines)
+            except Exception:
+                self._discard_file()
+                self.handleError(record)
+
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            try:
+                self.flush()
+            finally:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                for thread in self.compressors:
+                    thread.join()
+                self.compressors = []
+                logging.Handler.close(self)
+        finally:
+            self.release()
+
+    def _write(self, lines):
+        if self.file is None:
+            self._open()
+        if self._is_too_old():
+            self._rotate()
+
+        # Split the buffer between files at line boundaries, so that no file 
+        # grows beyond max_bytes (unless a single line is bigger than that).
+        size = self.file.tell()
+        block = []
+
+        for line in lines:
+            if self._is_too_big(size, len(line)):
+                self.file.write(b''.join(block))
+                self._rotate()
+                size, block = 0, []
+
+            block.append(line)
+            size += len(line)
+
+        self.file.write(b''.join(block))
+        self.file.flush()
+
+    def _discard_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except Exception:
+                pass
+            self.file = None
+
+    def _open(self):
+        self.file = open(self.path, 'ab')
+        self.opened = time.monotonic()
+
+    def _is_too_big(self, size, num_bytes):
+        return (self.max_bytes is not None and size > 0 and
+                size + num_bytes > self.max_bytes)
+
+    def _is_too_old(self):
+        return (self.rotate_interval is not None and self.file.tell() > 0 and
+                time.monotonic() - self.opened >= self.rotate_interval)
+
+    def _rotate(self):
+        import os, threading
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        # Make sure not to clobber an older file if two rotations happen in 
+        # the same second.
+        stem = '{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S'))
+        rotated, i = stem, 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            rotated, i = '{}-{}'.format(stem, i), i + 1
+
+        os.rename(self.path, rotated)
+
+        if self.compress:
+            self.compressors = [x for x in self.compressors if x.is_alive()]
+            thread = threading.Thread(target=_gzip_file, args=(rotated,))
+            thread.start()
+            self.compressors.append(thread)
+
+        self._open()
+
+def _gzip_file(path):
+    import os, gzip, shutil
+
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dest:
+        shutil.copyfileobj(src, dest)
+    os.remove(path)
+
+def _start_aggregator():
+    """
+    Listen for log records from child processes, and arrange for child 
+    processes to send their records here.
+
+    Forked children find out where to send their records via 
+    os.register_at_fork() (see _fork_aggregator()).  Children started by 
+    multiprocessing with the 'spawn' or 'forkserver' methods find out via 
+    the configuration that multiprocessing pickles along with every child 
+    process (see _AggregatorHandoff).  Nothing is passed on through the 
+    environment, so other subprocesses aren't affected.  Records received 
+    from child processes are handled by the root logger, so they end up in 
+    the same place (and go through the same background queue, if any) as 
+    records logged by this process.
+    """
+    import os, tempfile, threading, multiprocessing
+    from multiprocessing.connection import Listener
+    global _aggregator
+
+    _stop_aggregator()
+
+    # The directory is only accessible by the current user, and the socket 
+    # is further protected by a random authentication key.
+    directory = tempfile.mkdtemp(prefix='nonstdlib-')
+    address = os.path.join(directory, 'log.sock')
+    authkey = os.urandom(32)
+    listener = Listener(address, family='AF_UNIX', authkey=authkey)
+
+    receivers = []
+    thread = threading.Thread(
+            target=_accept_child_processes, args=(listener, receivers),
+            name='nonstdlib-aggregator', daemon=True)
+    thread.start()
+
+    # Process objects copy this configuration when they're created, and 
+    # pickle it along with everything else when they're spawned.
+    handoff = _AggregatorHandoff(
+            address, authkey, logging.getLogger().level, _record_fields,
+            os.getpid())
+    multiprocessing.current_process()._config[_AGGREGATOR_CONFIG] = handoff
+
+    if _aggregator is None:
+        import atexit
+        atexit.register(_stop_aggregator)
+
+    _aggregator = listener, directory, receivers, handoff
+
+def _stop_aggregator():
+    """
+    Stop accepting connections from child processes, and wait for the 
+    records sent by children that have already exited to be handled.
+    """
+    import shutil, multiprocessing
+
+    if not _aggregator:
+        return
+
+    listener, directory, receivers, handoff = _aggregator
+    listener.close()
+
+    # Children that have exited have closed their end of the connection, so 
+    # these threads will finish as soon as they've handled every record that 
+    # was sent.  Don't wait for children that are still running, though.  
+    # They may never exit on their own (e.g. daemonic workers, which 
+    # multiprocessing only terminates after this function is called), and 
+    # waiting for them would keep this process from exiting.
+    deadline = time.monotonic() + _AGGREGATOR_TIMEOUT
+    for thread, connection in list(receivers):
+        if _peer_has_closed(connection):
+            thread.join(max(deadline - time.monotonic(), 0))
+
+    shutil.rmtree(directory, ignore_errors=True)
+    multiprocessing.current_process()._config.pop(_AGGREGATOR_CONFIG, None)
+
+def _accept_child_processes(listener, receivers):
+    import threading
+    from multiprocessing import AuthenticationError
+
+    while True:
+        try:
+            connection = listener.accept()
+        except AuthenticationError:
+            continue
+        except OSError:
+            break
+
+        thread = threading.Thread(
+                target=_receive_records, args=(connection,),
+                name='nonstdlib-aggregator', daemon=True)
+        thread.start()
+
+        receivers[:] = [x for x in receivers if x[0].is_alive()] + \
+                [(thread, connection)]
+
+def _receive_records(connection):
+    with connection:
+        while True:
+            try:
+                record = logging.makeLogRecord(connection.recv())
+            except (EOFError, OSError):
+                break
+
+            logging.getLogger(record.name).handle(record)
+
+def _peer_has_closed(connection):
+    """
+    Return true if the child process at the other end of the given 
+    connection has closed it, even if some of the records it sent haven't 
+    been received yet.
+    """
+    import select
+
+    events = select.POLLHUP | getattr(select, 'POLLRDHUP', 0)
+    poll = select.poll()
+
+    try:
+        poll.register(connection.fileno(), events)
+    except (OSError, ValueError):
+        # The receiver already closed the connection, after reading to the 
+        # end of it.
+        return True
+
+    return any(x & events for fd, x in poll.poll(0))
+
+def _fork_aggregator():
+    """
+    Send the records logged by a forked child process to the aggregator.
+
+    The child inherits the parent's handlers, but it shouldn't use them: the 
+    aggregator passes the child's records on to those same handlers in the 
+    parent anyway, and writing to them directly is what the aggregator is 
+    there to prevent.  Children of children send their records to the same 
+    aggregator, but each needs a connection of its own.
+    """
+    global _aggregator
+    aggregator, _aggregator = _aggregator, None
+    root = logging.getLogger()
+
+    if aggregator:
+        handoff = aggregator[-1]
+        root.handlers = [_AggregatorHandler(handoff.address, handoff.authkey)]
+
+    elif any(isinstance(x, _AggregatorHandler) for x in root.handlers):
+        root.handlers = [
+                _AggregatorHandler(x.address, x.authkey)
+                if isinstance(x, _AggregatorHandler) else x
+                for x in root.handlers]
+
+    if isinstance(logging.lastResort, _AggregatorHandler):
+        logging.lastResort = _AggregatorHandler(
+                logging.lastResort.address, logging.lastResort.authkey)
+
+def _register_fork_hooks():
+    import os
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_fork_aggregator)
+
+class _AggregatorHandoff:
+    """
+    Tell child processes started by multiprocessing where to send their log 
+    records.
+
+    Unpickling one of these in a spawned child process makes the aggregator 
+    the handler of last resort (i.e. `logging.lastResort`), so that records 
+    are sent to the parent process only if nothing in the child ever 
+    configures any handlers.  Handlers that the child adds, either before or 
+    after it starts running, are always left alone.
+    """
+
+    def __init__(self, address, authkey, level, record_fields, pid):
+        self.address = address
+        self.authkey = authkey
+        self.level = level
+        self.record_fields = record_fields
+        self.pid = pid
+
+    def __reduce__(self):
+        args = self.address, self.authkey, self.level, self.record_fields, \
+                self.pid
+        return _connect_to_aggregator, args
+
+def _connect_to_aggregator(address, authkey, level, record_fields, pid):
+    """
+    Unpickle an `_AggregatorHandoff`, and send the records logged by this 
+    process to the aggregator unless this process is the aggregator.
+    """
+    import os
+
+    handoff = _AggregatorHandoff(address, authkey, level, record_fields, pid)
+    if _aggregator or pid == os.getpid():
+        return handoff
+
+    logging.lastResort = _AggregatorHandler(address, authkey)
+
+    # Log the same messages as the parent process, unless something in this 
+    # process has already configured logging.
+    root = logging.getLogger()
+    if not root.handlers:
+        root.setLevel(level)
+
+        global _record_fields
+        _record_fields = record_fields
+
+    return handoff
+
+def _disconnect_from_aggregator():
+    """
+    Stop sending log records to the parent process, if this process was 
+    doing so.  Child processes started from now on won't send their records 
+    to the parent process either.
+    """
+    import sys
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _AggregatorHandler):
+            root.removeHandler(handler)
+            handler.close()
+
+    if isinstance(logging.lastResort, _AggregatorHandler):
+        logging.lastResort.close()
+        logging.lastResort = logging._defaultLastResort
+
+    if not _aggregator and 'multiprocessing' in sys.modules:
+        import multiprocessing
+        multiprocessing.current_process()._config.pop(
+                _AGGREGATOR_CONFIG, None)
+
+class _AggregatorHandler(logging.Handler):
+    """
+    Send log records to the aggregator in the parent process.  The 
+    connection is made the first time a record is logged.
+    """
+
+    def __init__(self, address, authkey):
+        logging.Handler.__init__(self)
+        self.address = address
+        self.authkey = authkey
+        self.connection = None
+
+    def emit(self, record):
+        from multiprocessing.connection import Client
+
+        try:
+            if self.connection is None:
+                self.connection = Client(
+                        self.address, family='AF_UNIX', authkey=self.authkey)
+
+            # The record only refers to the rendered values of the fields in 
+            # the message (see _json_fields()), so this doesn't pickle any of 
+            # the objects those fields came from.
+            self.connection.send(_prepare_record(record).__dict__)
+
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            logging.Handler.close(self)
+        finally:
+            self.release()
+
+_aggregator = None
+_AGGREGATOR_TIMEOUT = 10
+_AGGREGATOR_CONFIG = 'nonstdlib_log_aggregator'
+
 
 def log(level, message, **kwargs):
     _log(level, message, **kwargs)
@@ -142,7 +928,8 @@ def fatal(message, **kwargs):
     _log(logging.FATAL, message, **kwargs)
 
 
-def _log(level, message, frame_depth=2, **kwargs):
+def _log(level, message, frame_depth=2,
+        limit=None, interval=1.0, sample=None, **kwargs):
     """
     Log the given message with the given log level using a logger named based 
     on the scope of the calling code.  This saves you time because you will be 
@@ -150,68 +937,307 @@ def _log(level, message, frame_depth=2, **kwargs):
     having to type anything.  This function is meant to be called by one or 
     more wrapper functions, so the `frame_depth` argument is provided to 
     specify which scope should be used to name the logger.
-    """
-    import inspect
 
+    Messages logged from inside loops can be thinned out using the `limit` 
+    and `sample` arguments.  If `limit` is given, at most that many messages 
+    will be logged from the calling line every `interval` seconds.  If 
+    `sample` is given, only one out of every that many messages will be 
+    logged from the calling line.  The number of messages that were 
+    suppressed is logged every `interval` seconds (if there were any), and 
+    when the program exits.
+    """
     try:
         # Inspect variables two frames up from where we currently are (by 
         # default).  One frame up is assumed to be one of the helper methods 
         # defined in this module, so we aren't interested in that.  Two frames 
-        # up should be the frame that's actually trying to log something.
+        # up should be the frame that's actually trying to log something.  
+        # Use sys._getframe() rather than inspect.stack(), because the latter 
+        # builds a FrameInfo (and reads the source code) for every frame on 
+        # the stack, which gets very slow when logging from deep call stacks.
 
-        frame = inspect.stack()[frame_depth][0]
-        frame_below = inspect.stack()[frame_depth-1][0]
-        
-        # Collect all the variables in the scope of the calling code, so they 
-        # can be substituted into the message.
-
-        scope = {}
-        scope.update(frame.f_globals)
-        scope.update(frame.f_locals)
+        frame = sys._getframe(frame_depth)
 
-        # If the calling frame is inside a class (deduced based on the presence 
-        # of a 'self' variable), name the logger after that class.  Otherwise 
-        # if the calling frame is inside a function, name the logger after that 
-        # function.  Otherwise name it after the module of the calling scope.
+        # Don't do any more work if the message is just going to be dropped.  
+        # Formatting the message (and copying the calling scope to do so) is 
+        # the expensive part, and debug messages in tight loops are usually 
+        # disabled.
 
-        self = frame.f_locals.get('self')
-        function = inspect.getframeinfo(frame).function
-        module = frame.f_globals['__name__']
+        logger = _get_logger(frame)
+        if not logger.isEnabledFor(level):
+            return
 
-        if self is not None:
-            name = '.'.join([
-                    self.__class__.__module__,
-                    self.__class__.__name__
-            ])
+        if limit is not None or sample is not None:
+            site = _get_call_site(frame, logger, level)
+            if not site.allow(limit, interval, sample):
+                return
+        
+        # Look up the variables used by the message in the scope of the 
+        # calling code.  The message is parsed once (and cached), so only the 
+        # names it actually references need to be looked up, rather than 
+        # copying every local and global variable.
 
-        elif function != '<module>':
-            name = '.'.join([module, function])
+        template = _compile_template(message)
+        variables = template.lookup(frame.f_locals, frame.f_globals)
 
+        # Only structured output needs the value of each field.  Getting 
+        # those values means filling in the template in python, which is 
+        # slower than str.format(), so don't do it unless necessary.
+        if _record_fields:
+            message, fields = template.render_fields(variables)
         else:
-            name = module
+            message, fields = template.format_string.format(**variables), None
+
+        if _coalesce is not None:
+            site = _get_call_site(frame, logger, level)
+            if not site.coalesce(message, _coalesce):
+                return
 
-        # Trick the logging module into reading file names and line numbers 
-        # from the correct frame by monkey-patching logging.currentframe() with 
-        # a function that returns the frame below the real calling frame (this 
-        # indirection is necessary because the logging module will look one 
-        # frame above whatever this function returns).  Undo all this after 
-        # logging our message, to avoid interfering with other loggers.
+        # Build the log record ourselves, so that the file name and line 
+        # number come from the calling frame rather than from this module.  
+        # This used to be done by temporarily monkey-patching 
+        # logging.currentframe(), but that isn't thread-safe.
 
-        with _temporarily_set_logging_frame(frame_below):
-            logger = logging.getLogger(name)
-            logger.log(level, message.format(**scope), **kwargs)
+        record = _make_record(logger, level, frame, message, **kwargs)
+        if fields is not None:
+            record.fields = _json_fields(fields)
+        logger.handle(record)
 
     finally:
         try: del frame
         except UnboundLocalError: pass
 
-@contextlib.contextmanager
-def _temporarily_set_logging_frame(frame):
+def _get_logger(frame):
+    """
+    Return the logger that should be used for messages coming from the given 
+    frame.
+
+    If the frame is inside a class (deduced based on the presence of a 'self' 
+    variable), the logger is named after that class.  Otherwise if the frame 
+    is inside a function, the logger is named after that function.  Otherwise 
+    it's named after the module of the calling scope.  The loggers are cached 
+    by code object and class, since working them out is the same for every 
+    message logged from the same place.
+    """
+    # This is called for every message, even those that end up being 
+    # disabled, so it has to be cheap.  Code objects don't cache their 
+    # hashes, so key the cache on their ids instead (the cache holds onto 
+    # each code object, so its id can't be reused).  Reading f_locals builds 
+    # a dictionary of every local variable, so only do it for code that 
+    # actually has a 'self' variable.
+    code = frame.f_code
+
     try:
-        stdlib_currentframe = logging.currentframe
-        logging.currentframe = lambda: frame
-        yield
-    finally:
-        logging.currentframe = stdlib_currentframe
+        logger, _ = _loggers[id(code)]
+    except KeyError:
+        names = code.co_varnames + code.co_cellvars + code.co_freevars
+        logger = None if 'self' in names else _name_logger(frame, None)
+        _loggers[id(code)] = logger, code
+
+    if logger is not None:
+        return logger
+
+    self = frame.f_locals.get('self')
+    cls = self.__class__ if self is not None else None
+    key = id(code), cls
+
+    try:
+        return _method_loggers[key]
+    except KeyError:
+        pass
+
+    _method_loggers[key] = logger = _name_logger(frame, cls)
+    return logger
+
+def _name_logger(frame, cls):
+    function = frame.f_code.co_name
+    module = frame.f_globals.get('__name__')
+
+    if cls is not None:
+        name = '.'.join([cls.__module__, cls.__name__])
+    elif function != '<module>':
+        name = '.'.join([module, function])
+    else:
+        name = module
+
+    return logging.getLogger(name)
+
+_loggers = {}
+_method_loggers = {}
+
+def _get_call_site(frame, logger, level):
+    # The code object is kept alive by _get_logger(), which is always called 
+    # first, so its id is a safe (and cheap) key.
+    key = id(frame.f_code), frame.f_lineno
+
+    try:
+        return _call_sites[key]
+    except KeyError:
+        pass
+
+    import atexit
+    if not _call_sites:
+        atexit.register(_summarize_call_sites)
+
+    code = frame.f_code
+    site = _CallSite(logger, level, code.co_filename, frame.f_lineno, code.co_name)
+    return _call_sites.setdefault(key, site)
+
+def _summarize_call_sites():
+    for site in list(_call_sites.values()):
+        site.summarize()
+        site.summarize_repeats()
+
+_call_sites = {}
+_coalesce = None
+_record_fields = False
+
+class _CallSite:
+    """
+    Keep track of how many messages have been logged (and suppressed) from a 
+    particular line of code, for the purpose of rate limiting and coalescing 
+    repeated messages.
+
+    The counters aren't protected by a lock, because this check has to be 
+    cheap enough to put in a hot loop.  If several threads log from the same 
+    line at once, the limits may be off by a message or two.
+    """
+
+    def __init__(self, logger, level, filename, lineno, function):
+        self.logger = logger
+        self.level = level
+        self.filename = filename
+        self.lineno = lineno
+        self.function = function
+        self.calls = 0
+        self.window_start = self.last_summary = time.monotonic()
+        self.window_count = 0
+        self.suppressed = 0
+        self.last_message = None
+        self.last_logged = None
+        self.repeats = 0
+        self.repeat_timer = None
+
+    def allow(self, limit, interval, sample):
+        now = time.monotonic()
+
+        if now - self.last_summary >= interval:
+            self.summarize(now)
+
+        self.calls += 1
+        if sample is not None and (self.calls - 1) % sample:
+            self.suppressed += 1
+            return False
+
+        if limit is not None:
+            if now - self.window_start >= interval:
+                self.window_start = now
+                self.window_count = 0
+
+            if self.window_count >= limit:
+                self.suppressed += 1
+                return False
+
+            self.window_count += 1
+
+        return True
+
+    def coalesce(self, message, timeout):
+        now = time.monotonic()
+
+        if message == self.last_message and now - self.last_logged < timeout:
+            self.repeats += 1
+
+            # Don't wait for the next call from this line to report the
+            # repeats, because there may never be one.
+            if self.repeat_timer is None:
+                self.repeat_timer = _start_timer(
+                        self.last_logged + timeout - now, self.summarize_repeats)
+
+            return False
+
+        self.summarize_repeats()
+        self.last_message = message
+        self.last_logged = now
+        return True
+
+    def summarize(self, now=None):
+        suppressed, self.suppressed = self.suppressed, 0
+        self.last_summary = time.monotonic() if now is None else now
+
+        if suppressed:
+            self.log("Suppressed {} message(s) from this line.".format(
+                suppressed))
+
+    def summarize_repeats(self):
+        timer, self.repeat_timer = self.repeat_timer, None
+        if timer is not None:
+            timer.cancel()
+
+        repeats, self.repeats = self.repeats, 0
+
+        if repeats:
+            self.log("Repeated {} more time(s): {}".format(
+                repeats, self.last_message))
+
+    def log(self, message):
+        record = self.logger.makeRecord(
+                self.logger.name, self.level, self.filename, self.lineno,
+                message, (), None, self.function)
+        self.logger.handle(record)
+
+def _start_timer(delay, callback):
+    import threading
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def _json_fields(fields):
+    """
+    Make the values of the fields referred to by a message safe to include in 
+    JSON output (and to send to other processes).  Numbers, strings, booleans 
+    and None are kept as they are, and everything else is replaced by its 
+    repr() (or a placeholder, if its repr() raises an exception).
+    """
+    return {k: _json_value(v) for k, v in fields.items()}
+
+def _json_value(value):
+    if isinstance(value, _JSON_SCALARS):
+        return value
+    try:
+        return repr(value)
+    except Exception:
+        return '<{} object (repr failed)>'.format(type(value).__name__)
+
+_JSON_SCALARS = str, int, float, bool, type(None)
+
+def _make_record(logger, level, frame, message,
+        exc_info=None, extra=None, stack_info=False):
+    """
+    Make a log record attributed to the given frame.  The keyword arguments 
+    have the same meaning as they do for logging.Logger.log().
+    """
+    code = frame.f_code
+    stack = None
+
+    if exc_info:
+        if isinstance(exc_info, BaseException):
+            exc_info = type(exc_info), exc_info, exc_info.__traceback__
+        elif not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+
+    if stack_info:
+        import io, traceback
+        buffer = io.StringIO()
+        buffer.write('Stack (most recent call last):\n')
+        traceback.print_stack(frame, file=buffer)
+        stack = buffer.getvalue().rstrip('\n')
+
+    return logger.makeRecord(
+            logger.name, level, code.co_filename, frame.f_lineno, message, (),
+            exc_info, code.co_name, extra, stack)
 
 
+# Send the log records of forked child processes to the aggregator, if this 
+# process is running one (or sending its own records to one).
+_register_fork_hooks()
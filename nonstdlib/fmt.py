@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 
+import re
+import string
+import functools
+
 class MagicFormatter:
 
     def __init__(self, args=None, kwargs=None, level=1):
@@ -11,25 +15,134 @@ class MagicFormatter:
         return self.__class__(args, kwargs, self.level)
 
     def __ror__(self, operand):
-        import inspect
+        import sys
 
         # Make sure the operand is a string.
         if not isinstance(operand, str):
             raise TypeError("'{}' is not a string", repr(operand))
 
         # Inspect variables from the source frame.
-        frame = inspect.stack()[self.level][0]
+        frame = sys._getframe(self.level)
+
+        # Look up only the variables that the message actually uses, giving
+        # precedence to keyword arguments, then locals, then globals.
+        template = _compile_template(operand)
+        return template.render(
+                self.args, self.kwargs, frame.f_locals, frame.f_globals)
+
+
+class _Template:
+    """
+    A format string that has been parsed ahead of time.
+
+    Parsing the string once means that rendering it only has to look up the
+    variables it refers to, rather than needing every variable that might be
+    referred to.  Positional fields (e.g. '{}' or '{0}') are filled in by the
+    positional arguments, as usual.
+    """
+
+    def __init__(self, format_string):
+        self.format_string = format_string
+        self.fields = tuple(_find_fields(format_string))
+        self.names = tuple(_unique(
+                _FIELD_NAME.match(x).group() for x in self.fields))
 
-        # Collect all the variables in the scope of the calling code, so they 
-        # can be substituted into the message.
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.format_string)
+
+    def render(self, args, *scopes):
+        """
+        Fill in the template.  Each named field is looked up in the given
+        scopes (which should be mappings) in order, and a KeyError is raised
+        if it can't be found in any of them.
+        """
+        return self.format_string.format(*args, **self.lookup(*scopes))
+
+    def lookup(self, *scopes):
+        """
+        Return a dictionary with the value of each named field in the
+        template, looked up as described in render().
+        """
         kwargs = {}
-        kwargs.update(frame.f_globals)
-        kwargs.update(frame.f_locals)
-        kwargs.update(self.kwargs)
 
-        return operand.format(*self.args, **kwargs)
+        for name in self.names:
+            for scope in scopes:
+                try:
+                    kwargs[name] = scope[name]
+                    break
+                except KeyError:
+                    pass
+            else:
+                raise KeyError(name)
 
+        return kwargs
 
+    def render_fields(self, kwargs):
+        """
+        Fill in the template with the values of the variables returned by
+        lookup(), and also return a dictionary mapping each named field in the
+        template (e.g. 'x.y[0]') to its value.  Each field is only evaluated
+        once, so properties and the like aren't called more than once.
+        """
+        formatter = _FieldRecorder()
+        message = formatter.vformat(self.format_string, (), kwargs)
+        return message, formatter.fields
 
-fmt = MagicFormatter()
 
+class _FieldRecorder(string.Formatter):
+    """
+    A formatter that remembers the value of every field it fills in.
+    """
+
+    def __init__(self):
+        self.fields = {}
+
+    def get_field(self, field_name, args, kwargs):
+        value, key = string.Formatter.get_field(self, field_name, args, kwargs)
+        self.fields[field_name] = value
+        return value, key
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_template(format_string):
+    # The cache is bounded, so messages that are built dynamically (e.g. with
+    # the '%' operator before being logged) can't grow it without limit.
+    return _Template(format_string)
+
+def _find_fields(format_string):
+    """
+    Yield every named field (e.g. 'x' or 'x.y[0]') in the given format string,
+    including those in nested format specs (e.g. '{x:{width}}').  Positional
+    fields are skipped, and each field is only yielded once.
+    """
+    formatter = string.Formatter()
+    format_strings = [format_string]
+    fields = []
+
+    while format_strings:
+        parsed = formatter.parse(format_strings.pop())
+
+        for literal, field, spec, conversion in parsed:
+            if field is None:
+                continue
+
+            name = _FIELD_NAME.match(field).group()
+            if name and not name.isdigit():
+                fields.append(field)
+
+            if spec:
+                format_strings.append(spec)
+
+    return _unique(fields)
+
+def _unique(items):
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+_FIELD_NAME = re.compile(r'[^.\[]*')
+
+
+fmt = MagicFormatter()
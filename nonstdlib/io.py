@@ -55,17 +55,84 @@ def swap_streams(stdout=None, stderr=None):
         sys.stderr = original_stderr
 
 @contextlib.contextmanager
-def capture_output(stdout=True, stderr=True, muffle=False):
+def capture_output(stdout=True, stderr=True, muffle=False, max_memory=None,
+        fd=False):
+    """
+    Capture anything written to stdout and stderr within a with-block.
+
+    The captured text is available from the `stdout` and `stderr` attributes 
+    of the object returned by the context manager.  Each write is stored as a 
+    separate chunk, and the chunks are only joined when one of those 
+    attributes is accessed, so capturing lots of small writes takes linear 
+    time.  If `max_memory` is given, each stream keeps at most that many 
+    characters in memory before spilling the rest to a temporary file.
+
+    Normally only output written via `sys.stdout` and `sys.stderr` is 
+    captured.  If `fd` is true, the file descriptors themselves (1 and 2) are 
+    redirected into pipes, so output written by C extensions, Fortran 
+    libraries, and child processes is captured too.  In this mode the 
+    `stdout` and `stderr` arguments can be used to leave one of the streams 
+    alone.
+    """
 
     class CapturedOutput:
 
         def __init__(self):
-            self.stdout = ""
-            self.stderr = ""
+            self._stdout = CaptureBuffer()
+            self._stderr = CaptureBuffer()
 
         def __contains__(self, phrase):
             return (phrase in self.stdout) or (phrase in self.stderr)
 
+        @property
+        def stdout(self):
+            return self._stdout.getvalue()
+
+        @property
+        def stderr(self):
+            return self._stderr.getvalue()
+
+    class CaptureBuffer:
+
+        def __init__(self):
+            import threading
+            self.chunks = []
+            self.file = None
+            self.size = 0
+            # In fd mode, the buffer is written from a background thread while 
+            # the caller may be reading it.
+            self.lock = threading.Lock()
+
+        def write(self, string):
+            with self.lock:
+                if self.file is not None:
+                    self.file.write(string)
+                    return
+
+                self.chunks.append(string)
+                self.size += len(string)
+
+                if max_memory is not None and self.size > max_memory:
+                    import tempfile
+                    self.file = tempfile.SpooledTemporaryFile(
+                            max_size=max_memory, mode='w+')
+                    self.file.write(''.join(self.chunks))
+                    self.chunks = []
+
+        def getvalue(self):
+            with self.lock:
+                if self.file is not None:
+                    self.file.seek(0)
+                    value = self.file.read()
+                    self.file.seek(0, 2)
+                    return value
+
+                # Remember the joined string, so it doesn't have to be joined 
+                # again the next time it's accessed.
+                value = ''.join(self.chunks)
+                self.chunks = [value] if value else []
+                return value
+
     class CapturedStream:
 
         def __init__(self, stream, write_callback):
@@ -82,16 +149,34 @@ def capture_output(stdout=True, stderr=True, muffle=False):
 
     captured_output = CapturedOutput()
 
-    def write_to_stdout(message):
-        captured_output.stdout += message
+    if fd:
+        with contextlib.ExitStack() as stack:
+            streams = {}
+
+            for name, fileno, buffer, enabled in [
+                    ('stdout', 1, captured_output._stdout, stdout),
+                    ('stderr', 2, captured_output._stderr, stderr)]:
+
+                if not enabled:
+                    continue
 
-    def write_to_stderr(message):
-        captured_output.stderr += message
+                # Python's own streams don't necessarily write to the file 
+                # descriptors being redirected (e.g. if they've already been 
+                # replaced), so write them directly to the redirected file 
+                # descriptors for the duration of the block.
+                getattr(sys, name).flush()
+                stack.enter_context(_capture_fd(fileno, buffer.write, muffle))
+                streams[name] = stack.enter_context(
+                        open(fileno, 'w', buffering=1, closefd=False))
 
+            stack.enter_context(swap_streams(**streams))
+            yield captured_output
+
+        return
 
     with swap_streams(
-            stdout=CapturedStream(sys.stdout, write_to_stdout),
-            stderr=CapturedStream(sys.stderr, write_to_stderr)):
+            stdout=CapturedStream(sys.stdout, captured_output._stdout.write),
+            stderr=CapturedStream(sys.stderr, captured_output._stderr.write)):
         yield captured_output
 
 @contextlib.contextmanager
@@ -105,16 +190,115 @@ def capture_stderr(muffle=False):
         yield output.stderr
 
 @contextlib.contextmanager
-def muffle(stdout=True, stderr=True):
-    with capture_output(stdout, stderr, muffle=True):
+def muffle(stdout=True, stderr=True, fd=False):
+    with capture_output(stdout, stderr, muffle=True, fd=fd):
+        yield
+
+@contextlib.contextmanager
+def _capture_fd(fd, write_callback, muffle):
+    """
+    Redirect the given file descriptor into a pipe, and pass everything 
+    written to it to the given callback (as text) from a background thread.  
+    Unless `muffle` is true, the output is also still written to wherever the 
+    file descriptor originally pointed.  The file descriptor is restored when 
+    the with-block exits, even if an exception was raised.
+
+    Child processes started within the block may keep writing to the pipe 
+    after the block exits.  That output isn't captured, but the background 
+    thread keeps reading it (and passing it on to the original file 
+    descriptor, unless `muffle` is true) until the children close the pipe, 
+    so that they don't get killed by SIGPIPE.  If this process exits first, 
+    the children will get SIGPIPE the next time they write.
+    """
+    import os, time, codecs, select, threading
+
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    captured = threading.Event()
+    stop_at = None
+
+    def finish_capturing():
+        write_callback(decoder.decode(b'', final=True))
+        captured.set()
+
+    def drain():
+        try:
+            while True:
+                ready, _, _ = select.select([read_fd], [], [], _DRAIN_POLL)
+
+                # Once the with-block has exited, only keep capturing while 
+                # there's more output ready (and not for too long).  A child 
+                # process that inherited the file descriptor may hold the 
+                # pipe open long after the block is over, so we can't wait 
+                # for EOF.  Keep reading (without capturing) until then, 
+                # though, because closing the pipe would kill the child.
+                if stop_at is not None and not captured.is_set():
+                    if not ready or time.monotonic() > stop_at:
+                        finish_capturing()
+                if not ready:
+                    continue
+
+                try:
+                    data = os.read(read_fd, 65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+
+                if not muffle:
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(saved_fd, view):]
+
+                if not captured.is_set():
+                    write_callback(decoder.decode(data))
+
+        finally:
+            if not captured.is_set():
+                finish_capturing()
+            os.close(read_fd)
+            os.close(saved_fd)
+
+    saved_fd = os.dup(fd)
+    try:
+        read_fd, write_fd = os.pipe()
+        try:
+            os.set_blocking(read_fd, False)
+            os.dup2(write_fd, fd)
+        except:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+    except:
+        os.close(saved_fd)
+        raise
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+
+    try:
         yield
 
+    finally:
+        # Restoring the file descriptor closes the last copy of the write end 
+        # of the pipe (unless a child process still has it open), which lets 
+        # the thread know that there's nothing left to read.  Otherwise the 
+        # thread stops capturing once the pipe goes quiet, and takes care of 
+        # closing the pipe (and the saved file descriptor) on its own.
+        os.dup2(saved_fd, fd)
+        stop_at = time.monotonic() + _DRAIN_TIMEOUT
+        captured.wait()
+
+_DRAIN_POLL = 0.1
+_DRAIN_TIMEOUT = 1.0
+
 @contextlib.contextmanager
-def keep_on_one_line():
+def keep_on_one_line(fps=None):
     """
     Keep all the output generated within a with-block on one line.  Whenever a 
     new line would be printed, instead reset the cursor to the beginning of the 
-    line and print the new line without a line break.
+    line and print the new line without a line break.  If `fps` is given, the 
+    line is redrawn at most that many times per second (see `throttle()`).
     """
 
     class CondensedStream:
@@ -123,11 +307,15 @@ def keep_on_one_line():
             self.sys_stdout = sys.stdout
 
         def write(self, string):
+            string = string.replace('\n', ' ')
+            if not string.strip():
+                return
+            if _throttled(self.write, string):
+                return
+
             with swap_streams(self.sys_stdout):
-                string = string.replace('\n', ' ')
                 string = truncate_to_fit_terminal(string)
-                if string.strip():
-                    update(string)
+                _update(string)
 
         def flush(self):
             with swap_streams(self.sys_stdout):
@@ -135,8 +323,266 @@ def keep_on_one_line():
 
 
     with swap_streams(CondensedStream()):
+        if fps is None:
+            yield
+        else:
+            with throttle(fps):
+                yield
+
+@contextlib.contextmanager
+def throttle(fps=30):
+    """
+    Redraw the output of `update()`, `progress()`, and `keep_on_one_line()` at 
+    most `fps` times per second within a with-block.
+
+    Updates that come too soon after the last one aren't drawn right away, but 
+    the most recent one is remembered, and is drawn as soon as it's allowed to 
+    be (even if no other updates come along) or when the with-block exits.  
+    Skipping an update costs no more than checking the time, so it's fine to 
+    update once per iteration of even a very tight loop.
+    """
+    global _throttle
+    previous, _throttle = _throttle, _Throttle(fps)
+
+    try:
         yield
 
+    finally:
+        current, _throttle = _throttle, previous
+
+        with current.lock:
+            if current.timer is not None:
+                current.timer.cancel()
+                current.timer = None
+
+            pending = current.pop_pending()
+
+        if pending is not None:
+            function, args = pending
+            function(*args)
+
+class _Throttle:
+    """
+    Keep track of when the last update was drawn, and of the most recent 
+    update that was skipped.
+
+    Skipping an update doesn't take the lock, because it has to be cheap.  
+    Instead, the skipped update is stored in a deque, which can be safely 
+    appended to and popped from different threads.  The lock is only taken 
+    to draw an update, so that the timer thread and the thread making the 
+    updates can't draw them out of order.
+    """
+
+    def __init__(self, fps):
+        import threading, collections
+
+        self.interval = 1 / fps
+        self.next_draw = 0
+        self.pending = collections.deque(maxlen=1)
+        self.timer = None
+        self.lock = threading.RLock()
+
+    def pop_pending(self):
+        try:
+            return self.pending.pop()
+        except IndexError:
+            return None
+
+    def defer(self, now):
+        import threading
+
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(
+                        max(self.next_draw - now, 0), self.draw_deferred)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def draw_deferred(self):
+        with self.lock:
+            # The with-block may have exited while this timer was waiting for 
+            # the lock.
+            if self.timer is None:
+                return
+
+            # Clear the timer before taking the pending update, so that an 
+            # update skipped after this point will start a new timer.
+            self.timer = None
+            pending = self.pop_pending()
+
+            # Let the update through _throttled(), so the time of this draw 
+            # is recorded like any other.
+            if pending is not None:
+                function, args = pending
+                self.next_draw = 0
+                function(*args)
+
+def _throttled(function, *args):
+    """
+    Return true if the given update should be skipped, because the last one 
+    was drawn too recently.  In that case, remember the update so it can be 
+    drawn later.
+    """
+    import time
+
+    throttle = _throttle
+    if throttle is None:
+        return False
+
+    now = time.monotonic()
+    if now < throttle.next_draw:
+        throttle.pending.append((function, args))
+
+        # Don't rely on another update coming along to draw this one.
+        if throttle.timer is None:
+            throttle.defer(now)
+
+        return True
+
+    with throttle.lock:
+        throttle.next_draw = now + throttle.interval
+        throttle.pending.clear()
+        return False
+
+_throttle = None
+
+
+class Dashboard:
+    """
+    Display a block of status lines that can each be updated independently.
+
+    Each line is identified by a key, and lines are added (below the existing 
+    ones) the first time a key is updated.  Any thread can update any line.  
+    Only the lines that changed since the last redraw are rewritten, and all 
+    the cursor movements and text for a redraw are sent to the terminal in a 
+    single write.  Redraws happen at most `fps` times per second, and the 
+    final state is always drawn when the dashboard is closed:
+
+        with Dashboard() as dashboard:
+            for job in jobs:
+                dashboard.update(job.name, job.status)
+    """
+
+    def __init__(self, keys=(), fps=10, stream=None):
+        import threading
+
+        self.fps = fps
+        self.stream = stream
+        self.lines = {}
+        self.drawn = []
+        self.row = 0
+        self.next_draw = 0
+        self.timer = None
+        self.lock = threading.RLock()
+
+        for key in keys:
+            self.lines[key] = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, key, text):
+        """
+        Change the text of the line with the given key, and redraw the 
+        dashboard unless it was drawn too recently.  In that case, the redraw 
+        happens as soon as it's allowed to.
+        """
+        import time, threading
+
+        with self.lock:
+            self.lines[key] = text
+
+            if not self.fps:
+                self.redraw()
+                return
+
+            now = time.monotonic()
+            if now >= self.next_draw:
+                self.next_draw = now + 1 / self.fps
+                self.redraw()
+
+            # Don't rely on another update coming along to draw this one.
+            elif self.timer is None:
+                self.timer = threading.Timer(
+                        self.next_draw - now, self._redraw_deferred)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _redraw_deferred(self):
+        import time
+
+        with self.lock:
+            # The dashboard may have been closed while this timer was waiting 
+            # for the lock.
+            if self.timer is None:
+                return
+
+            self.timer = None
+            self.next_draw = time.monotonic() + 1 / self.fps
+            self.redraw()
+
+    def redraw(self):
+        """
+        Rewrite any lines that have changed since the last redraw.
+        """
+        with self.lock:
+            stream = self.stream or sys.stdout
+            lines = [
+                    truncate_to_fit_terminal(x.replace('\n', ' '))
+                    for x in self.lines.values()
+            ]
+            chunks = []
+
+            def move_to(row):
+                if row < self.row:
+                    chunks.append('\033[%dA' % (self.row - row))
+                if row > self.row:
+                    chunks.append('\033[%dB' % (row - self.row))
+                self.row = row
+
+            for i, (old, new) in enumerate(zip(self.drawn, lines)):
+                if old != new:
+                    move_to(i)
+                    chunks.append('\r\033[2K' + new)
+
+            # New lines are added by printing newlines from the bottom of the 
+            # existing block, which scrolls the terminal if necessary.
+            for i in range(len(self.drawn), len(lines)):
+                if i > 0:
+                    move_to(i - 1)
+                    chunks.append('\n')
+                chunks.append('\r\033[2K' + lines[i])
+                self.row = i
+
+            if chunks:
+                stream.write(''.join(chunks))
+                stream.flush()
+
+            self.drawn = lines
+
+    def close(self):
+        """
+        Draw the final state of every line, and leave the cursor on the line 
+        below the dashboard.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            self.redraw()
+
+            if self.drawn:
+                stream = self.stream or sys.stdout
+                lines_below = len(self.drawn) - 1 - self.row
+                stream.write(
+                        ('\033[%dB' % lines_below if lines_below else '') + '\n')
+                stream.flush()
+                self.row = len(self.drawn)
+
 
 def print_color(string, name, style='normal', when='auto'):
     print(color(string, name, style, when))
@@ -152,21 +598,27 @@ def write_color(string, name, style='normal', when='auto'):
 
 def update(string):
     """ Replace the existing line with the given string. """
-    clear()
-    write(string)
+    if _throttled(update, string): return
+    _update(string)
     
 def update_color(string, name, style='normal', when='auto'):
     """ Replace the existing line with the given colored string. """
-    clear()
-    write_color(string, name, style, when)
+    if _throttled(update_color, string, name, style, when): return
+    _update(color(string, name, style, when))
 
 def progress(current, total):
     """ Display a simple progress report. """
-    update('[%d/%d] ' % (current, total))
+    if _throttled(progress, current, total): return
+    _update('[%d/%d] ' % (current, total))
 
 def progress_color(current, total, name, style='normal', when='auto'):
     """ Display a simple, colored progress report. """
-    update_color('[%d/%d] ' % (current, total), name, style, when)
+    if _throttled(progress_color, current, total, name, style, when): return
+    _update(color('[%d/%d] ' % (current, total), name, style, when))
+
+def _update(string):
+    clear()
+    write(string)
 
 def color(string, name, style='normal', when='auto'):
     """ Change the color of the given string. """
@@ -251,7 +703,33 @@ def terminal_height():
     return terminal_size()[1]
 
 def terminal_size():
-    """ Return the size of the terminal as a (width, height) tuple. """
+    """
+    Return the size of the terminal as a (width, height) tuple.
+
+    The size is cached, because working it out can take several system calls.  
+    The cache is cleared whenever the terminal is resized (as signaled by 
+    SIGWINCH).  If it isn't possible to handle SIGWINCH (e.g. on Windows, or 
+    if this function is first called from a thread other than the main one), 
+    the size is instead looked up again if the cached value is more than a 
+    second old.
+    """
+    import time
+    global _terminal_size, _terminal_size_time
+
+    size = _terminal_size
+    if size is not None:
+        if _sigwinch_installed:
+            return size
+        if time.monotonic() - _terminal_size_time < _TERMINAL_SIZE_POLL:
+            return size
+
+    _install_sigwinch_handler()
+
+    _terminal_size = size = _query_terminal_size()
+    _terminal_size_time = time.monotonic()
+    return size
+
+def _query_terminal_size():
     import os
     env = os.environ
 
@@ -280,6 +758,39 @@ def terminal_size():
 
     return int(cr[1]), int(cr[0])
 
+def _install_sigwinch_handler():
+    """
+    Clear the cached terminal size whenever the terminal is resized.  Any 
+    handler that was already installed for SIGWINCH is still called.
+    """
+    import signal
+    global _sigwinch_installed, _sigwinch_previous
+
+    if _sigwinch_installed:
+        return
+
+    def on_sigwinch(signum, frame):
+        global _terminal_size
+        _terminal_size = None
+
+        if callable(_sigwinch_previous):
+            _sigwinch_previous(signum, frame)
+
+    try:
+        _sigwinch_previous = signal.signal(signal.SIGWINCH, on_sigwinch)
+    except (AttributeError, ValueError, OSError):
+        # Either SIGWINCH doesn't exist on this platform, or this isn't the 
+        # main thread.  Fall back on polling.
+        return
+
+    _sigwinch_installed = True
+
+_terminal_size = None
+_terminal_size_time = None
+_sigwinch_installed = False
+_sigwinch_previous = None
+_TERMINAL_SIZE_POLL = 1.0
+
 def truncate_to_fit_terminal(string):
     width = terminal_width()
     if len(string) < width:
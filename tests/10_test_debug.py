@@ -4,7 +4,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import os, logging
+import os, sys, queue, logging, pytest
 from nonstdlib.debug import *
 
 class ListHandler(logging.Handler):
@@ -52,6 +52,30 @@ class Bar:  # (no fold)
 
 Bar()
 
+## Make sure the logger names are right for inherited methods and deep stacks.
+
+class Baz(Bar):  # (no fold)
+    pass
+
+Baz()
+
+def recurse(depth):  # (no fold)
+    if depth: return recurse(depth - 1)
+    info("Deep level")
+
+recurse(200)
+
+## Make sure local variables take precedence over global ones.
+
+scope = 'global'
+info("Scope: {scope}")
+
+def local_scope():  # (no fold)
+    scope = 'local'
+    info("Scope: {scope}")
+
+local_scope()
+
 
 def test_public_interface():
     assert handler[0].levelno == 10
@@ -105,6 +129,86 @@ def test_logger_scopes():
     assert handler[9].lineno == 51
     assert handler[9].funcName == '__init__'
     
+def test_logger_names_inherited():
+    assert handler[10].name == '10_test_debug.Baz'
+    assert handler[10].msg == "Method level"
+    assert handler[10].funcName == '__init__'
+
+def test_logger_names_deep_stack():
+    assert handler[11].name == '10_test_debug.recurse'
+    assert handler[11].msg == "Deep level"
+    assert handler[11].pathname == __file__
+    assert handler[11].lineno == 64
+    assert handler[11].funcName == 'recurse'
+
+def test_logger_variables():
+    assert handler[12].msg == "Scope: global"
+    assert handler[13].msg == "Scope: local"
+
+def test_threads():
+    import threading
+
+    currentframe = logging.currentframe
+    num_records = len(handler.records)
+
+    def first_worker():
+        for i in range(100):
+            info("First worker")
+
+    def second_worker():
+        for i in range(100):
+            info("Second worker")
+
+    threads = [
+            threading.Thread(target=first_worker),
+            threading.Thread(target=second_worker),
+    ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    records = handler.records[num_records:]
+    assert len(records) == 200
+
+    for record in records:
+        assert record.pathname == __file__
+        if record.msg == "First worker":
+            assert record.funcName == 'first_worker'
+            assert record.lineno == first_worker.__code__.co_firstlineno + 2
+        else:
+            assert record.funcName == 'second_worker'
+            assert record.lineno == second_worker.__code__.co_firstlineno + 2
+
+    assert logging.currentframe is currentframe
+
+def test_exc_info():
+    try:
+        raise ValueError("Caught exception")
+    except ValueError:
+        error("Caught error", exc_info=True)
+
+    assert handler[-1].msg == "Caught error"
+    assert handler[-1].exc_info[0] is ValueError
+    assert handler[-1].funcName == 'test_exc_info'
+
+def test_disabled_levels():
+    logger = logging.getLogger('10_test_debug.test_disabled_levels')
+    logger.setLevel(logging.WARNING)
+    num_records = len(handler.records)
+
+    try:
+        # The message shouldn't even be formatted if its level is disabled, 
+        # so the undefined variable shouldn't cause an error.
+        debug("{undefined}")
+        info("{undefined}")
+        assert len(handler.records) == num_records
+
+        warning("Enabled level")
+        assert len(handler.records) == num_records + 1
+        assert handler[-1].msg == "Enabled level"
+
+    finally:
+        logger.setLevel(logging.NOTSET)
+
 def test_log_level():
     assert log_level(1) == 1
     assert log_level("99") == 99
@@ -116,4 +220,464 @@ def test_verbosity():
     assert verbosity(2) == logging.DEBUG
     assert verbosity(3) == 0
 
+debug_module = sys.modules['nonstdlib.debug']
+
+@pytest.fixture
+def isolated_config():
+    """
+    Provide a version of config() that doesn't affect the other tests.
+
+    Calling it removes all the handlers from the root logger before 
+    configuring it (including any that pytest added to capture log messages).  
+    The original handlers and level are restored, and any background threads 
+    started by the configuration are stopped, when the test finishes.
+    """
+    handlers = root.handlers
+    level = root.level
+
+    def isolated_config(**kwargs):
+        root.handlers = []
+        config(**kwargs)
+
+    try:
+        yield isolated_config
+
+    finally:
+        debug_module._stop_background_logging()
+        debug_module._stop_aggregator()
+        debug_module._coalesce = None
+        debug_module._record_fields = False
+        root.handlers = handlers
+        root.setLevel(level)
+
+def test_background(isolated_config):
+    import io
+
+    stream = io.StringIO()
+    isolated_config(stream=stream, format='%(message)s', background=True)
+    assert [type(x) for x in root.handlers] == \
+            [debug_module._BackgroundHandler]
+
+    for i in range(10):
+        info("Background {i}")
+
+    debug_module._stop_background_logging()
+    assert [type(x) for x in root.handlers] == [logging.StreamHandler]
+    assert stream.getvalue() == ''.join(
+            "Background {}\n".format(i) for i in range(10))
+
+def test_background_fork(isolated_config, tmpdir):
+    import multiprocessing
+
+    # Forked children don't inherit the background thread, so they have to 
+    # handle their records themselves.
+    def child():
+        assert [type(x) for x in root.handlers] == [logging.FileHandler]
+        info("Forked child")
+
+    path = tmpdir / 'log.txt'
+    isolated_config(
+            stream=None, file=str(path), format='%(message)s',
+            background=True)
+
+    process = multiprocessing.get_context('fork').Process(target=child)
+    process.start()
+    process.join()
+
+    assert process.exitcode == 0
+    assert path.read() == "Forked child\n"
+
+def test_background_dropped():
+    records = queue.Queue(2)
+    handler = debug_module._BackgroundHandler(records)
+
+    for i in range(5):
+        record = logging.LogRecord(
+                'test', logging.INFO, __file__, 0, "%d", (i,), None)
+        handler.handle(record)
+
+    assert handler.dropped == 3
+    assert records.get_nowait().msg == "0"
+    assert records.get_nowait().msg == "1"
+
+def test_rate_limits():
+    num_records = len(handler.records)
+
+    for i in range(100):
+        info("Limited {i}", limit=5, interval=60)
+
+    records = handler.records[num_records:]
+    assert [x.msg for x in records] == ["Limited {}".format(i) for i in range(5)]
+
+    debug_module._summarize_call_sites()
+
+    records = handler.records[num_records:]
+    assert len(records) == 6
+    assert records[-1].msg == "Suppressed 95 message(s) from this line."
+    assert records[-1].lineno == records[0].lineno
+    assert records[-1].funcName == 'test_rate_limits'
+
+def test_sampling():
+    num_records = len(handler.records)
+
+    for i in range(100):
+        info("Sampled {i}", sample=10, interval=60)
+
+    records = handler.records[num_records:]
+    assert [x.msg for x in records] == \
+            ["Sampled {}".format(i) for i in range(0, 100, 10)]
+
+def test_structured(isolated_config):
+    import io, json
+
+    stream = io.StringIO()
+    isolated_config(stream=stream, structured=True)
+
+    x, y = 1, [2, 3]
+    info("Structured {x} {y[1]}")
+
+    line = json.loads(stream.getvalue())
+    assert line['name'] == '10_test_debug.test_structured'
+    assert line['level'] == 'INFO'
+    assert line['file'] == __file__
+    assert line['function'] == 'test_structured'
+    assert line['message'] == "Structured 1 3"
+    assert line['fields'] == {'x': 1, 'y[1]': 3}
+
+def test_structured_fields(isolated_config):
+    import io, json
+
+    stream = io.StringIO()
+    isolated_config(stream=stream, structured=True)
+
+    # Only the values that are actually rendered should be included, and 
+    # they should always be serializable.
+    data = list(range(100000))
+    keys = {1: 'one', (2, 3): 'two'}
+    info("Fields {data.__len__} {keys[1]} {keys!r:.10}")
+
+    text = stream.getvalue()
+    assert len(text) < 1000
+
+    fields = json.loads(text)['fields']
+    assert fields['keys[1]'] == 'one'
+    assert fields['keys'] == repr(keys)
+    assert '__len__' in fields['data.__len__']
+
+def test_structured_fields_evaluated_once(isolated_config):
+    import io, json
+
+    class Counter:  # (no fold)
+        calls = 0
+
+        @property
+        def prop(self):
+            Counter.calls += 1
+            return Counter.calls
+
+        def __repr__(self):
+            raise ValueError
+
+        def __format__(self, spec):
+            return 'counter'
+
+    counter = Counter()
+
+    # Plain-text messages don't need the values of the fields, so they 
+    # shouldn't be evaluated more than once, or repr()'d.
+    stream = io.StringIO()
+    isolated_config(stream=stream, format='%(message)s')
+    info("Plain {counter.prop} {counter}")
+    assert stream.getvalue() == "Plain 1 counter\n"
+
+    stream = io.StringIO()
+    isolated_config(stream=stream, structured=True)
+    info("Structured {counter.prop} {counter}")
+
+    line = json.loads(stream.getvalue())
+    assert line['message'] == "Structured 2 counter"
+    assert line['fields']['counter.prop'] == 2
+    assert 'repr failed' in line['fields']['counter']
+
+def test_structured_rotation(tmpdir):
+    import gzip, json
+
+    path = tmpdir / 'log.jsonl'
+    handler = debug_module._StructuredFileHandler(
+            str(path), max_bytes=1000, compress=True)
+    handler.setFormatter(debug_module._JsonFormatter())
+
+    # Use the default buffer size, which is much bigger than max_bytes.
+    for i in range(200):
+        record = logging.LogRecord(
+                'test', logging.INFO, __file__, 0, "Rotated %d", (i,), None)
+        handler.handle(record)
+
+    handler.close()
+
+    segments = tmpdir.listdir()
+    assert len(segments) > 1
+    assert path in segments
+
+    lines = []
+    for segment in segments:
+        if segment.ext == '.gz':
+            with gzip.open(str(segment), 'rt') as file:
+                segment_lines = file.readlines()
+            assert sum(len(x) for x in segment_lines) <= 1000
+            lines += segment_lines
+        else:
+            assert segment.size() <= 1000
+            lines += segment.readlines()
+
+    messages = sorted(json.loads(x)['message'] for x in lines)
+    assert messages == sorted("Rotated {}".format(i) for i in range(200))
+
+def test_structured_flush_interval(tmpdir):
+    import json, time
+
+    path = tmpdir / 'log.jsonl'
+    handler = debug_module._StructuredFileHandler(str(path))
+    handler.setFormatter(debug_module._JsonFormatter())
+    handler.flush_interval = 0.1
+
+    try:
+        # The message should be written even though nothing else is logged.
+        record = logging.LogRecord(
+                'test', logging.INFO, __file__, 0, "Idle", (), None)
+        handler.handle(record)
+        assert not path.exists()
+
+        deadline = time.monotonic() + 5
+        while not path.exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert json.loads(path.read())['message'] == "Idle"
+
+    finally:
+        handler.close()
+
+def test_structured_io_error(tmpdir, capsys):
+    import json
+
+    # The directory doesn't exist yet, so the file can't be opened.
+    path = tmpdir / 'missing' / 'log.jsonl'
+    handler = debug_module._StructuredFileHandler(str(path))
+    handler.setFormatter(debug_module._JsonFormatter())
+
+    try:
+        record = logging.LogRecord(
+                'test', logging.ERROR, __file__, 0, "Lost", (), None)
+        handler.handle(record)
+
+        assert 'FileNotFoundError' in capsys.readouterr().err
+
+        # The handler should recover once the problem is fixed.
+        path.dirpath().mkdir()
+        record = logging.LogRecord(
+                'test', logging.ERROR, __file__, 0, "Recovered", (), None)
+        handler.handle(record)
+
+        assert json.loads(path.read())['message'] == "Recovered"
+
+    finally:
+        handler.close()
+
+def preconfigured_child():
+    # This module adds a handler to the root logger when it's imported, so 
+    # this process has configured logging before it starts running.
+    info("Preconfigured child")
+
+def test_multiprocess(isolated_config, tmpdir, monkeypatch):
+    import io, time, threading, textwrap, subprocess, multiprocessing
+
+    def wait_for(num_lines):
+        for i in range(100):
+            lines = stream.getvalue().splitlines()
+            if len(lines) >= num_lines: break
+            time.sleep(0.05)
+        return sorted(lines)
+
+    def forked_child():
+        # The lock can't be pickled, but it shouldn't need to be.
+        lock = threading.Lock()
+        info("Forked child {lock.locked.__name__}")
+
+    def run(context, target, *args):
+        process = multiprocessing.get_context(context).Process(
+                target=target, args=args)
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+
+    # Spawned children have to import the functions they run.
+    (tmpdir / 'multiprocess_children.py').write(textwrap.dedent('''\
+        import nonstdlib
+
+        def spawned_child(x):
+            nonstdlib.info("Spawned child {x}")
+
+        def configured_child(path):
+            nonstdlib.config(stream=None, file=path, format='%(message)s')
+            nonstdlib.info("Configured child")
+    '''))
+    monkeypatch.syspath_prepend(str(tmpdir))
+    import multiprocess_children
+
+    stream = io.StringIO()
+    isolated_config(stream=stream, format='%(message)s', multiprocess=True)
+
+    # Forked child processes.
+    run('fork', forked_child)
+    assert wait_for(1) == ["Forked child locked"]
+
+    # Child processes that start a new interpreter.
+    run('spawn', multiprocess_children.spawned_child, 1)
+    assert wait_for(2) == ["Forked child locked", "Spawned child 1"]
+
+    # Child processes that configure logging themselves, either before or 
+    # after they start running.
+    path = tmpdir / 'child.log'
+    run('spawn', multiprocess_children.configured_child, str(path))
+    run('spawn', preconfigured_child)
+
+    assert path.read() == "Configured child\n"
+    assert wait_for(2) == ["Forked child locked", "Spawned child 1"]
+
+    # Processes that aren't started by multiprocessing don't know about the 
+    # aggregator, so their handlers are left alone.
+    path = tmpdir / 'subprocess.log'
+    code = ('import sys, logging; '
+            'logging.basicConfig(filename=sys.argv[1], format="%(message)s"); '
+            'import nonstdlib; nonstdlib.warning("Unrelated process")')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(debug_module.__file__))
+    subprocess.check_call([sys.executable, '-c', code, str(path)], env=env)
+
+    assert path.read() == "Unrelated process\n"
+    assert wait_for(2) == ["Forked child locked", "Spawned child 1"]
+
+    debug_module._stop_aggregator()
+    assert 'nonstdlib_log_aggregator' not in \
+            multiprocessing.current_process()._config
+
+def test_multiprocess_exit(tmpdir):
+    import subprocess, textwrap
+
+    # Records sent by child processes shouldn't be lost when the parent exits 
+    # right after the children do.
+    path = tmpdir / 'log.txt'
+    code = textwrap.dedent('''\
+        import sys, multiprocessing, nonstdlib
+
+        nonstdlib.config(
+                stream=None, file=sys.argv[1], format='%(message)s',
+                multiprocess=True)
+
+        def child(n):
+            for i in range(2000):
+                nonstdlib.info("Child {n}: {i}")
+
+        if __name__ == '__main__':
+            context = multiprocessing.get_context('fork')
+            processes = [context.Process(target=child, args=(n,)) for n in range(4)]
+            for process in processes: process.start()
+            for process in processes: process.join()
+    ''')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(debug_module.__file__))
+    subprocess.check_call([sys.executable, '-c', code, str(path)], env=env)
+
+    assert len(path.readlines()) == 8000
+
+def test_multiprocess_exit_daemon(tmpdir):
+    import time, subprocess, textwrap
+
+    # The parent shouldn't wait for children that are still running when it 
+    # exits (e.g. daemonic children, which multiprocessing terminates after 
+    # the aggregator stops).
+    path = tmpdir / 'log.txt'
+    code = textwrap.dedent('''\
+        import sys, time, multiprocessing, nonstdlib
+
+        nonstdlib.config(
+                stream=None, file=sys.argv[1], format='%(message)s',
+                multiprocess=True)
+
+        def child():
+            nonstdlib.info("Daemonic child")
+            time.sleep(60)
+
+        if __name__ == '__main__':
+            context = multiprocessing.get_context('fork')
+            process = context.Process(target=child, daemon=True)
+            process.start()
+            time.sleep(0.5)
+    ''')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(debug_module.__file__))
+
+    start = time.monotonic()
+    subprocess.check_call([sys.executable, '-c', code, str(path)], env=env)
+
+    assert time.monotonic() - start < 5
+    assert path.read() == "Daemonic child\n"
+
+def test_coalesce(isolated_config):
+    import io
+
+    stream = io.StringIO()
+    isolated_config(stream=stream, format='%(message)s', coalesce=60)
+
+    for i in range(10):
+        warn("Retrying {i}" if i == 6 else "Retrying")
+
+    for site in debug_module._call_sites.values():
+        if site.function == 'test_coalesce':
+            site.summarize_repeats()
+
+    assert stream.getvalue().splitlines() == [
+            "Retrying",
+            "Repeated 5 more time(s): Retrying",
+            "Retrying 6",
+            "Retrying",
+            "Repeated 2 more time(s): Retrying",
+    ]
+
+def test_coalesce_timeout(isolated_config):
+    import io, time
+
+    stream = io.StringIO()
+    isolated_config(stream=stream, format='%(message)s', coalesce=0.1)
+
+    for i in range(3):
+        warn("Retrying")
+
+    # The repeats should be reported even if nothing else is logged.
+    time.sleep(0.5)
+
+    assert stream.getvalue().splitlines() == [
+            "Retrying",
+            "Repeated 2 more time(s): Retrying",
+    ]
+
+def test_background_rotating_file(isolated_config, tmpdir):
+    import logging.handlers
+
+    path = tmpdir / 'log.txt'
+    handler = logging.handlers.RotatingFileHandler(
+            str(path), maxBytes=500, backupCount=10)
+
+    root.handlers = [handler]
+    debug_module._start_background_logging(0)
+
+    for i in range(100):
+        info("Rotating {i}")
+
+    debug_module._stop_background_logging()
+    handler.close()
 
+    # The handler should've been allowed to rotate its own files.
+    segments = [x for x in tmpdir.listdir() if x.basename.startswith('log.txt')]
+    assert len(segments) > 1
+    assert all(x.size() <= 500 for x in segments)
@@ -26,3 +26,226 @@ def test_muffle():
 This test doesn't really test anything, it just makes sure the 
 muffle function returns without raising any exceptions.  You shouldn't ever see 
 this message.""")
+
+def test_capture_output_chunks():
+    import sys
+
+    with nonstdlib.capture_output(muffle=True) as output:
+        for i in range(1000):
+            sys.stdout.write('{}\n'.format(i))
+            assert output.stdout.endswith('{}\n'.format(i))
+
+    assert output.stdout == ''.join('{}\n'.format(i) for i in range(1000))
+    assert output.stderr == ''
+
+def test_capture_output_max_memory():
+    import sys
+
+    with nonstdlib.capture_output(muffle=True, max_memory=100) as output:
+        for i in range(1000):
+            sys.stdout.write('{}\n'.format(i))
+        sys.stderr.write('small\n')
+
+    assert output.stdout == ''.join('{}\n'.format(i) for i in range(1000))
+    assert output.stderr == 'small\n'
+    assert 'small' in output
+
+def test_capture_output_fd():
+    import os, sys, subprocess
+
+    with nonstdlib.capture_output(fd=True, muffle=True) as output:
+        print('python stdout')
+        print('python stderr', file=sys.stderr)
+        os.write(1, b'fd stdout\n')
+        os.write(2, b'fd stderr\n')
+        subprocess.check_call([sys.executable, '-c', 'print("child stdout")'])
+
+    assert output.stdout == 'python stdout\nfd stdout\nchild stdout\n'
+    assert output.stderr == 'python stderr\nfd stderr\n'
+
+def test_capture_output_fd_exception():
+    import os, pytest
+
+    stdout = os.fstat(1)
+
+    with pytest.raises(ZeroDivisionError):
+        with nonstdlib.capture_output(fd=True, muffle=True) as output:
+            os.write(1, b'before error\n')
+            1 / 0
+
+    assert output.stdout == 'before error\n'
+    assert os.fstat(1) == stdout
+
+def test_capture_output_fd_child_process():
+    import os, sys, time, subprocess
+
+    # A child process that outlives the block still has a copy of the 
+    # redirected file descriptors, so the pipe won't be closed when it ends.
+    start = time.monotonic()
+    with nonstdlib.capture_output(fd=True, muffle=True) as output:
+        child = subprocess.Popen(['sleep', '5'])
+        os.write(1, b'parent stdout\n')
+
+    try:
+        assert time.monotonic() - start < 4
+        assert output.stdout == 'parent stdout\n'
+    finally:
+        child.kill()
+        child.wait()
+
+def test_capture_output_fd_late_child_output():
+    import subprocess
+
+    # A child process that writes after the block has exited shouldn't be 
+    # killed by SIGPIPE.
+    with nonstdlib.muffle(fd=True):
+        child = subprocess.Popen(['sh', '-c', 'sleep 1.5; echo late'])
+
+    assert child.wait() == 0
+
+def test_muffle_fd():
+    import os
+
+    with nonstdlib.muffle(fd=True):
+        os.write(1, b"You shouldn't ever see this message.\n")
+
+def test_throttle():
+    import io
+
+    stdout = io.StringIO()
+
+    with nonstdlib.swap_streams(stdout):
+        with nonstdlib.throttle(fps=1):
+            for i in range(1, 1001):
+                nonstdlib.progress(i, 1000)
+
+    # Only the first and last updates should've been drawn.
+    assert stdout.getvalue() == '\033[2K\r[1/1000] \033[2K\r[1000/1000] '
+
+def test_throttle_stalled():
+    import io, time
+
+    stdout = io.StringIO()
+
+    with nonstdlib.swap_streams(stdout):
+        with nonstdlib.throttle(fps=10):
+            nonstdlib.progress(1, 3)
+            nonstdlib.progress(2, 3)
+
+            # The skipped update should be drawn even though nothing else 
+            # happens until the with-block exits.
+            time.sleep(0.5)
+            assert stdout.getvalue() == '\033[2K\r[1/3] \033[2K\r[2/3] '
+
+            nonstdlib.progress(3, 3)
+
+    assert stdout.getvalue().endswith('\033[2K\r[3/3] ')
+
+def test_keep_on_one_line_fps():
+    import io
+
+    stdout = io.StringIO()
+
+    with nonstdlib.swap_streams(stdout):
+        with nonstdlib.keep_on_one_line(fps=1):
+            for i in range(1, 1001):
+                print(i)
+
+    assert stdout.getvalue().endswith('\033[2K\r1000')
+    assert stdout.getvalue().count('\033[2K') == 2
+
+def test_terminal_size_cache():
+    import os, sys, signal
+    io_module = sys.modules['nonstdlib.io']
+
+    signals = []
+    def previous_handler(signum, frame):
+        signals.append(signum)
+
+    original_handler = signal.signal(signal.SIGWINCH, previous_handler)
+    io_module._terminal_size = None
+    io_module._sigwinch_installed = False
+
+    try:
+        size = nonstdlib.terminal_size()
+        assert io_module._sigwinch_installed
+        assert io_module._terminal_size == size
+        assert nonstdlib.terminal_size() == size
+
+        # Resizing the terminal should clear the cache, and still call the 
+        # handler that was installed before.
+        os.kill(os.getpid(), signal.SIGWINCH)
+        assert io_module._terminal_size is None
+        assert signals == [signal.SIGWINCH]
+        assert nonstdlib.terminal_size() == size
+
+    finally:
+        signal.signal(signal.SIGWINCH, original_handler)
+        io_module._terminal_size = None
+        io_module._sigwinch_installed = False
+
+def test_dashboard():
+    import io
+
+    stdout = io.StringIO()
+    dashboard = nonstdlib.Dashboard(['a', 'b'], fps=0, stream=stdout)
+
+    dashboard.update('a', 'A1')
+    assert stdout.getvalue() == '\r\033[2KA1\n\r\033[2K'
+
+    # Only the changed line is redrawn.
+    stdout.seek(0); stdout.truncate()
+    dashboard.update('a', 'A2')
+    assert stdout.getvalue() == '\033[1A\r\033[2KA2'
+
+    stdout.seek(0); stdout.truncate()
+    dashboard.update('b', 'B1')
+    assert stdout.getvalue() == '\033[1B\r\033[2KB1'
+
+    # Unchanged lines aren't redrawn at all.
+    stdout.seek(0); stdout.truncate()
+    dashboard.update('b', 'B1')
+    assert stdout.getvalue() == ''
+
+    # New keys are added below the existing lines.
+    dashboard.update('c', 'C1')
+    assert stdout.getvalue() == '\n\r\033[2KC1'
+
+    stdout.seek(0); stdout.truncate()
+    dashboard.update('a', 'A3')
+    dashboard.close()
+    assert stdout.getvalue() == '\033[2A\r\033[2KA3\033[2B\n'
+
+def test_dashboard_deferred():
+    import io, time
+
+    stdout = io.StringIO()
+    dashboard = nonstdlib.Dashboard(['job1'], fps=10, stream=stdout)
+
+    # The second update comes too soon to be drawn right away, but it should 
+    # still be drawn without waiting for another update.
+    dashboard.update('job1', 'running')
+    dashboard.update('job1', 'done')
+    time.sleep(0.5)
+
+    assert dashboard.drawn == ['done']
+    dashboard.close()
+
+def test_dashboard_threads():
+    import io, threading
+
+    stdout = io.StringIO()
+
+    def worker(key):
+        for i in range(100):
+            dashboard.update(key, '{} {}'.format(key, i))
+
+    with nonstdlib.Dashboard(fps=1000, stream=stdout) as dashboard:
+        threads = [
+                threading.Thread(target=worker, args=(str(i),))
+                for i in range(5)
+        ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+    assert sorted(dashboard.drawn) == ['{} 99'.format(i) for i in range(5)]
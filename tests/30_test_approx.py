@@ -4,6 +4,7 @@
 
 import pytest
 import doctest
+import math
 
 from nonstdlib import approx
 from operator import eq, ne
@@ -285,3 +286,591 @@ def test_doctests():
     runner = MyDocTestRunner()
     runner.run(test)
 
+
+def test_numpy_array():
+    np = pytest.importorskip('numpy')
+
+    actual = np.array([1e8 + 1e0, 1e0 + 1e-8, 1e-8 + 1e-16])
+    expected = np.array([1e8, 1e0, 1e-8])
+
+    assert actual == approx(expected, rel=5e-8, abs=0.0)
+    assert actual != approx(expected, rel=5e-9, abs=0.0)
+    assert list(actual) == approx(expected, rel=5e-8, abs=0.0)
+    assert actual == approx(list(expected), rel=5e-8, abs=0.0)
+
+    assert np.array([1, 2]) != approx(np.array([1]))
+    assert np.array([1, 2]) != approx(np.array([1, 2, 3]))
+    assert np.arange(10) == approx(np.arange(10))
+
+def test_numpy_matches_scalar():
+    np = pytest.importorskip('numpy')
+
+    # Every combination of these values should give the same result whether
+    # it's compared using numpy or one number at a time.
+    values = [
+            0.0, -0.0, 1e-13, 1e-12, 2e-12, 1.0, 1.0 + 1e-6, 1.0 + 2e-6,
+            -1.0, 1e100, 1e100 + 1e94, inf, -inf, nan,
+    ]
+    tolerances = [
+            dict(),
+            dict(rel=1e-3),
+            dict(abs=1e-3),
+            dict(rel=0.0, abs=0.0),
+            dict(rel=inf, abs=0.0),
+            dict(abs=inf),
+            dict(rel=-1.0),
+            dict(abs=nan),
+    ]
+
+    def scalar_eq(a, x, **kwargs):
+        try:
+            return a == approx(x, **kwargs)
+        except ValueError:
+            return ValueError
+
+    def vector_eq(a, x, **kwargs):
+        try:
+            return np.array([a]) == approx(np.array([x]), **kwargs)
+        except ValueError:
+            return ValueError
+
+    for kwargs in tolerances:
+        for a in values:
+            for x in values:
+                assert scalar_eq(a, x, **kwargs) == vector_eq(a, x, **kwargs), \
+                        (a, x, kwargs)
+
+def test_numpy_big_ints():
+    np = pytest.importorskip('numpy')
+
+    # Integers that can't be exactly represented as floats should be compared
+    # exactly, just like python integers are.
+    assert 2**62 + 1 != approx(2**62, abs=0.5)
+    assert [2**62 + 1] != approx([2**62], abs=0.5)
+    assert np.array([2**62 + 1]) != approx(np.array([2**62]), abs=0.5)
+    assert np.array([2**62 + 1]) != approx([2**62], abs=0.5)
+    assert np.array([2**62 + 1]) == approx(np.array([2**62]), abs=1)
+    assert np.array([2**63], dtype='uint64') != \
+            approx(np.array([2**63 + 1], dtype='uint64'), abs=0.5)
+    assert approx([1.0, 2.0]).report(np.array([2**62, 2])).mismatch_count == 1
+
+def test_numpy_first_error():
+    np = pytest.importorskip('numpy')
+
+    # Errors are only raised if the comparison gets as far as the element
+    # with the invalid tolerance, just like in the scalar case.
+    assert np.array([0.0, 1.0]) != approx(np.array([inf, 0.0]), rel=inf)
+    with pytest.raises(ValueError):
+        np.array([1.0, 1.0]) == approx(np.array([1.0, 0.0]), rel=inf)
+
+def test_numpy_complex():
+    np = pytest.importorskip('numpy')
+
+    actual = np.array([1.000001 + 1.0j, 1.0 + 1.000001j, inf + 0j])
+    expected = np.array([1.0 + 1.0j, 1.0 + 1.0j, inf + 0j])
+
+    assert actual == approx(expected, rel=5e-6, abs=0)
+    assert actual != approx(expected, rel=5e-7, abs=0)
+
+def test_buffer_protocol():
+    np = pytest.importorskip('numpy')
+    from array import array
+
+    assert array('d', [0.1 + 0.2, 0.2 + 0.4]) == approx([0.3, 0.6])
+    assert array('d', [0.1 + 0.2, 0.2 + 0.5]) != approx([0.3, 0.6])
+    assert [0.1 + 0.2, 0.2 + 0.4] == approx(array('d', [0.3, 0.6]))
+
+def test_precompiled():
+    x = approx([1.0, 2.0], rel=1e-3)
+
+    # The expected values are only compiled once.
+    assert x.expected is x.expected
+    assert x.expected[0].tolerance == approx(1e-3)
+    assert x.expected[1].tolerance == approx(2e-3)
+
+    # The object can be reused for any number of comparisons.
+    for i in range(3):
+        assert [1.0005, 2.001] == x
+        assert [1.002, 2.001] != x
+
+    # Changing the tolerances after the fact isn't allowed, because they've
+    # already been compiled.
+    with pytest.raises(AttributeError):
+        x.rel = 1e-6
+    with pytest.raises(AttributeError):
+        x.expected[0].abs = 1e-6
+
+def test_precompiled_invalid_tolerance():
+    # Invalid tolerances are only calculated once, and the error is only
+    # raised if a comparison needs the tolerance.
+    x = approx([0.0, 1.0], rel=inf)
+    print(x)
+
+    for i in range(2):
+        assert [0.0, 1.0] == x
+        with pytest.raises(ValueError):
+            [1.0, 1.0] == x
+
+def test_precompiled_huge_int():
+    # Integers too big to convert to floats don't have a tolerance, but they
+    # can still be exactly equal.
+    assert 2**1100 == approx(2**1100)
+    assert [2**1100] == approx([2**1100])
+    with pytest.raises(OverflowError):
+        2**1100 + 1 == approx(2**1100)
+
+def test_stream():
+    from nonstdlib import approx_stream
+
+    def numbers(n, error=0.0):
+        for i in range(1, n + 1):
+            yield i + error
+
+    assert numbers(10, 1e-8) == approx(list(range(1, 11)))
+    assert numbers(10, 1e-4) != approx(list(range(1, 11)))
+    assert numbers(9) != approx(list(range(1, 11)))
+    assert numbers(11) != approx(list(range(1, 11)))
+
+    for chunk_size in [1, 3, 10, 100]:
+        assert approx_stream(numbers(10, 1e-8), numbers(10), chunk_size=chunk_size)
+        assert not approx_stream(numbers(10, 1e-4), numbers(10), chunk_size=chunk_size)
+        assert not approx_stream(numbers(9), numbers(10), chunk_size=chunk_size)
+        assert not approx_stream(numbers(11), numbers(10), chunk_size=chunk_size)
+        assert approx_stream(numbers(0), numbers(0), chunk_size=chunk_size)
+
+    from decimal import Decimal
+    assert approx_stream(
+            (Decimal('1.000001'), Decimal('2.000001')),
+            (Decimal('1.0'), Decimal('2.0')),
+            rel=Decimal('5e-6'), abs=0)
+
+def test_stream_short_circuit():
+    from itertools import count
+    from nonstdlib import approx_stream
+
+    # Infinite generators can be compared, as long as there's a mismatch.
+    assert not approx_stream(count(), count(1), chunk_size=16)
+    assert not approx_stream(count(), range(10))
+    assert count() != approx(list(range(10)))
+
+def test_binary_files(tmp_path):
+    np = pytest.importorskip('numpy')
+    import mmap
+
+    expected = np.linspace(1, 2, 100000)
+    expected_path = tmp_path / 'expected.bin'
+    expected.tofile(str(expected_path))
+
+    actual = expected + 1e-8
+    actual_path = tmp_path / 'actual.bin'
+    actual.tofile(str(actual_path))
+
+    x = approx(expected_path, dtype='float64')
+    assert actual == x
+    assert actual + 1e-4 != x
+    assert actual[:-1] != x
+    assert actual_path == x
+    assert str(actual_path) == approx(str(expected_path), dtype='float64')
+
+    with open(str(actual_path), 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        assert buffer == x
+        assert memoryview(buffer) == x
+        buffer.close()
+
+    assert actual.tobytes() == x
+    assert bytearray(actual.tobytes()) == x
+
+    empty_path = tmp_path / 'empty.bin'
+    empty_path.touch()
+    assert [] == approx(empty_path, dtype='float64')
+    assert [1.0] != approx(empty_path, dtype='float64')
+
+    # Buffers and files that don't hold a whole number of values.
+    ragged_path = tmp_path / 'ragged.bin'
+    ragged_path.write_bytes(b'abc')
+    assert b'abc' != approx([1.0], dtype='float64')
+    assert bytearray(b'abc') != approx([1.0], dtype='float64')
+    assert ragged_path != approx([1.0], dtype='float64')
+
+def test_list_compiled_with_numpy():
+    pytest.importorskip('numpy')
+    from nonstdlib.approx import _NOT_COMPILED
+
+    # Long lists of numbers should be compared using numpy, without building 
+    # an ApproxNonIterable for every item.
+    x = approx([0.3, 0.6, 0.9] * 100)
+    assert x._array is not None
+    assert [0.1 + 0.2, 0.2 + 0.4, 0.3 + 0.6] * 100 == x
+    assert [0.3, 0.6, 1.0] * 100 != x
+    assert x._scalars is None
+
+    # Short lists are faster to compare without numpy.
+    x = approx([0.3, 0.6, 0.9])
+    assert x._array is _NOT_COMPILED
+    assert [0.1 + 0.2, 0.2 + 0.4, 0.3 + 0.6] == x
+    assert [0.3, 0.6, 1.0] != x
+
+    # Lists that aren't flat should still be compared recursively.
+    assert approx([[0.3], [0.6]] * 100)._nested is not None
+    assert approx([0.3, 'z'] * 100)._nested is not None
+    assert approx([[0.3], [0.6]])._nested is not None
+
+def test_buffers_not_copied():
+    np = pytest.importorskip('numpy')
+    from array import array
+
+    # The expected values should be compared in place, and their tolerances
+    # shouldn't be precomputed (which would allocate an array just as big).
+    expected = array('d', [1.0, 2.0, 3.0])
+    x = approx(expected)
+    assert np.shares_memory(x._array.flat, np.frombuffer(expected))
+    assert x._array._precomputed is None
+
+    assert [1.0, 2.0, 3.0] == x
+    assert array('d', [1.0, 2.0, 3.0]) == x
+    assert array('d', [1.0, 2.0, 3.1]) != x
+    assert memoryview(array('d', [1.0, 2.0, 3.0])) == x
+
+def test_repr_bounded():
+    x = approx(list(range(1000)))
+    assert repr(x).count(',') < 20
+    assert '...' in repr(x)
+    assert '...' not in repr(approx(list(range(10))))
+
+def test_report():
+    x = approx([1.0, 2.0, 3.0, 0.0], rel=1e-3, abs=0)
+
+    report = x.report([1.0, 2.1, 3.0, 1.0])
+    assert not report.ok
+    assert report.mismatch_count == 2
+    assert report.mismatches[0] == (1, 2.1, 2.0, approx(2e-3))
+    assert report.mismatches[1] == (3, 1.0, 0.0, 0.0)
+    assert report.max_abs_error == approx(1.0)
+    assert report.max_rel_error == inf
+
+    report = x.report([1.0, 2.0, 3.0, 0.0])
+    assert report.ok
+    assert report.mismatch_count == 0
+    assert report.mismatches == []
+
+    report = x.report([1.0, 2.0, 3.0])
+    assert not report.ok
+    assert report.mismatch_count == 0
+    assert 'expected 4 values, got 3' in repr(report)
+
+    report = x.report(iter([1.0, 2.0, 3.0, 0.0, 5.0]))
+    assert not report.ok
+    assert report.actual_size == 5
+
+    # Iterators that run on for more than one chunk past the expected values.
+    report = approx([1.0, 2.0]).report(iter([1.0] * 200000))
+    assert not report.ok
+    assert report.actual_size == 200000
+    assert report.mismatch_count == 1
+
+def test_report_numpy():
+    np = pytest.importorskip('numpy')
+
+    expected = np.arange(1, 1000001, dtype=float)
+    actual = expected.copy()
+    actual[::1000] *= 1.001
+    actual[7] = nan
+
+    report = approx(expected).report(actual, max_mismatches=3)
+    assert not report.ok
+    assert report.mismatch_count == 1001
+    assert [m.index for m in report.mismatches] == [0, 7, 1000]
+    assert report.max_rel_error == approx(1e-3)
+    assert report.max_abs_error == approx(999.001)
+    assert len(repr(report).splitlines()) == 5
+
+    # Invalid tolerances are reported rather than raised.
+    report = approx(np.array([0.0]), rel=inf).report(np.array([1.0]))
+    assert report.mismatch_count == 1
+    assert math.isnan(report.mismatches[0].tolerance)
+
+def test_threads():
+    np = pytest.importorskip('numpy')
+    from nonstdlib.approx import _COMPARE_CHUNK_SIZE
+
+    n = 20 * _COMPARE_CHUNK_SIZE
+    expected = np.linspace(1, 2, n)
+
+    for threads in [2, 4, True]:
+        x = approx(expected, threads=threads)
+        assert expected * (1 + 1e-8) == x
+        assert expected[:-1] != x
+
+        for i in [0, n // 3, n - 1]:
+            actual = expected.copy()
+            actual[i] *= 1.001
+            assert actual != x
+
+    # If there's both an invalid tolerance and a mismatch, the error should
+    # only be raised if it comes first, even if it's found by a thread that
+    # gets cut short.
+    expected = np.ones(n)
+    expected[n // 2] = 0
+    actual = np.ones(n)
+    actual[n // 2] = 1
+    actual[-1] = 2
+
+    with pytest.raises(ValueError):
+        actual == approx(expected, rel=inf, threads=4)
+
+    expected[-1] = inf
+    actual[n // 2] = 0
+    actual[1] = 2
+    expected[1] = inf
+    assert actual != approx(expected, rel=inf, threads=4)
+
+def test_index():
+    np = pytest.importorskip('numpy')
+    from nonstdlib import ApproxIndex
+
+    index = ApproxIndex([1.0, 2.0, 1.0 + 1e-9, 3.0])
+    assert list(index.find(1.0)) == [0, 2]
+    assert list(index.find(4.0)) == []
+    assert len(index) == 4
+
+    index.insert([1.0 - 1e-9, nan, inf])
+    assert len(index) == 7
+    assert list(index.find(1.0)) == [0, 2, 4]
+    assert list(index.find(inf)) == [6]
+    assert list(ApproxIndex(index.values, abs=1).find(nan)) == []
+    with pytest.raises(ValueError):
+        index.find(nan)
+    assert [list(x) for x in index.find_many([3.0, 2.0, 5.0])] == [[3], [1], []]
+    assert index.find_many([]) == []
+
+    with pytest.raises(TypeError):
+        ApproxIndex([1j])
+
+def test_index_matches_brute_force():
+    np = pytest.importorskip('numpy')
+    from nonstdlib import ApproxIndex
+
+    rng = np.random.RandomState(0)
+    values = np.concatenate([
+        rng.randint(0, 20, size=50) * 0.5,
+        rng.randint(0, 20, size=50) * 0.5 * (1 + 1e-7),
+        rng.randint(0, 20, size=50) * 0.5 + 1e-13,
+        [0.0, -0.0, inf, -inf, nan, 1e-300],
+    ])
+    rng.shuffle(values)
+    queries = np.concatenate([np.arange(-1, 11, 0.5), [0.0, inf, -inf, nan]])
+
+    tolerances = [
+            dict(),
+            dict(rel=1e-3),
+            dict(abs=1e-3),
+            dict(rel=0, abs=0),
+            dict(rel=0, abs=inf),
+    ]
+    def brute_force(q, **kwargs):
+        try:
+            x = approx(q, **kwargs)
+            return [j for j, v in enumerate(values) if v == x]
+        except ValueError:
+            return ValueError
+
+    def indexed(index, q):
+        try:
+            return list(index.find(q))
+        except ValueError:
+            return ValueError
+
+    for kwargs in tolerances:
+        index = ApproxIndex(values, **kwargs)
+        for q in queries:
+            assert indexed(index, q) == brute_force(q, **kwargs), (q, kwargs)
+
+        valid = [q for q in queries if brute_force(q, **kwargs) is not ValueError]
+        qi, vi = index.join(valid)
+        assert list(zip(qi, vi)) == [
+                (i, j)
+                for i, q in enumerate(valid)
+                for j in brute_force(q, **kwargs)
+        ]
+
+def test_index_invalid_tolerance():
+    np = pytest.importorskip('numpy')
+    from nonstdlib import ApproxIndex
+
+    index = ApproxIndex([0.0, 1.0], rel=inf)
+    assert list(index.find(1.0)) == [0, 1]
+    with pytest.raises(ValueError):
+        index.find(0.0)
+    assert list(ApproxIndex([0.0, 0.0], rel=inf).find(0.0)) == [0, 1]
+
+def test_ulps():
+    import struct
+
+    def next_float(x, n=1):
+        i = struct.unpack('<q', struct.pack('<d', x))[0]
+        return struct.unpack('<d', struct.pack('<q', i + n))[0]
+
+    assert next_float(1.0, 3) == approx(1.0, ulps=3)
+    assert next_float(1.0, 4) != approx(1.0, ulps=3)
+    assert next_float(-1.0, 3) == approx(-1.0, ulps=3)
+    assert next_float(-1.0, 4) != approx(-1.0, ulps=3)
+    assert 1.0 == approx(1.0, ulps=0)
+    assert next_float(1.0) != approx(1.0, ulps=0)
+
+    # Adjacent numbers on either side of zero.
+    assert next_float(0.0) == approx(-next_float(0.0), ulps=2)
+    assert next_float(0.0) != approx(-next_float(0.0), ulps=1)
+    assert 0.0 == approx(-0.0, ulps=0)
+
+    # Non-finite numbers.
+    assert inf == approx(inf, ulps=1)
+    assert inf != approx(1.7976931348623157e308, ulps=1)
+    assert 1.7976931348623157e308 != approx(inf, ulps=1)
+    assert nan != approx(nan, ulps=1)
+
+    # If only ULPs are given, the other tolerances aren't considered.
+    assert 1e-13 != approx(0.0, ulps=1)
+    assert 1e-13 == approx(0.0, ulps=1, abs=1e-12)
+    assert next_float(1.0, 10) == approx(1.0, ulps=1, rel=1e-6)
+    assert next_float(0.0, 10) == approx(0.0, ulps=10, rel=inf)
+
+    with pytest.raises(ValueError):
+        approx(1.0, ulps=-1)
+    with pytest.raises(TypeError):
+        1j == approx(1.1j, ulps=1)
+
+    print(approx(1.0, ulps=1))
+    print(approx(1.0, ulps=1, abs=1e-6))
+
+def test_ulps_numpy():
+    np = pytest.importorskip('numpy')
+
+    x = np.array([1.0, -1.0, 0.0, 1e300, inf, 5e-324])
+    y = x.copy()
+    for i in range(3):
+        y = np.nextafter(y, np.inf)
+
+    y[4] = inf
+    assert y == approx(x, ulps=3)
+    assert y != approx(x, ulps=2)
+    assert list(y) == approx(list(x), ulps=3)
+    assert list(y) != approx(list(x), ulps=2)
+
+    x32 = np.array([1.0, 2.0], dtype=np.float32)
+    y32 = np.nextafter(x32, np.float32(3))
+    assert y32 == approx(x32, ulps=1)
+    assert y32 != approx(x32, ulps=0)
+    assert y32[0] == approx(x32[0], ulps=1)
+
+    # Long doubles don't have a ULP distance (unless they're really just
+    # doubles), but they can still be exactly equal.
+    xld = np.array([1.0, 2.0], dtype=np.longdouble)
+    assert xld == approx(xld.copy(), ulps=1)
+    if xld.itemsize not in (2, 4, 8):
+        with pytest.raises(TypeError, match="aren't supported"):
+            xld + 1 == approx(xld, ulps=1)
+
+def test_nested():
+    expected = {
+            'a': 1.0,
+            'b': [2.0, 3.0],
+            'c': {'d': [4.0, (5.0, 'e')], 'f': None},
+            'g': 'h',
+    }
+    x = approx(expected, rel=1e-3)
+
+    assert {
+            'a': 1.0001,
+            'b': [2.0001, 3.0001],
+            'c': {'d': [4.0001, (5.0001, 'e')], 'f': None},
+            'g': 'h',
+    } == x
+
+    def different(**changes):
+        import copy
+        actual = copy.deepcopy(expected)
+        for key, value in changes.items():
+            actual[key] = value
+        return actual
+
+    assert different(a=1.1) != x
+    assert different(b=[2.0, 3.1]) != x
+    assert different(b=[2.0]) != x
+    assert different(c={'d': [4.0, (5.1, 'e')], 'f': None}) != x
+    assert different(c={'d': [4.0, (5.0, 'E')], 'f': None}) != x
+    assert different(c={'d': [4.0, (5.0, 'e')]}) != x
+    assert different(g='H') != x
+    assert different(i=1.0) != x
+    assert [1.0] != x
+
+    print(x)
+
+def test_nested_lists():
+    assert [[0.1 + 0.2], [0.2 + 0.4, 0.3 + 0.6]] == approx([[0.3], [0.6, 0.9]])
+    assert [[0.1 + 0.2], [0.2 + 0.4]] != approx([[0.3], [0.6, 0.9]])
+    assert [[0.1 + 0.2], [0.2 + 0.5, 0.3 + 0.6]] != approx([[0.3], [0.6, 0.9]])
+    assert ['a', 0.1 + 0.2] == approx(['a', 0.3])
+    assert ['b', 0.1 + 0.2] != approx(['a', 0.3])
+
+def test_nested_report():
+    x = approx({'x': 0.3, 'y': [0.6, 'z']})
+    assert {'x': 0.1 + 0.2, 'y': [0.2 + 0.4, 'z']} == x
+
+    # Nested values can only be compared, not flattened or reported.
+    with pytest.raises(TypeError, match='nested'):
+        x.report({'x': 0.3, 'y': [0.6, 'z']})
+    with pytest.raises(TypeError, match='nested'):
+        x.expected
+
+def test_nested_dataclass():
+    import dataclasses
+
+    @dataclasses.dataclass
+    class Point:
+        x: float
+        y: float
+        label: str
+
+    @dataclasses.dataclass
+    class Segment:
+        start: Point
+        end: Point
+
+    expected = Segment(Point(0.3, 0.6, 'a'), Point(0.9, 1.2, 'b'))
+    actual = Segment(Point(0.1 + 0.2, 0.2 + 0.4, 'a'), Point(0.9, 1.2, 'b'))
+
+    assert actual == approx(expected)
+    assert Segment(Point(0.3, 0.6, 'a'), Point(0.9, 1.3, 'b')) != approx(expected)
+    assert Segment(Point(0.3, 0.6, 'a'), Point(0.9, 1.2, 'c')) != approx(expected)
+    assert Point(0.3, 0.6, 'a') != approx(expected)
+
+    # Like dataclass equality, different classes are never equal, even if 
+    # they have the same fields.
+    @dataclasses.dataclass
+    class OtherPoint:
+        x: float
+        y: float
+        label: str
+
+    assert OtherPoint(0.3, 0.6, 'a') != approx(Point(0.3, 0.6, 'a'))
+
+def test_nested_structured_array():
+    np = pytest.importorskip('numpy')
+
+    dtype = [('name', 'U8'), ('x', 'f8'), ('pos', [('u', 'f4'), ('v', 'f4')])]
+    expected = np.array([('a', 0.3, (1.0, 2.0)), ('b', 0.6, (3.0, 4.0))], dtype)
+    actual = expected.copy()
+    actual['x'] += 1e-9
+
+    assert actual == approx(expected)
+    assert [actual, 1.0] == approx([expected, 1.0])
+
+    actual['pos']['v'][1] = 4.1
+    assert actual != approx(expected)
+
+    actual = expected.copy()
+    actual['name'][0] = 'c'
+    assert actual != approx(expected)
+    assert actual[:1] != approx(expected)
+    assert np.array([0.3, 0.6]) != approx(expected)
@@ -2,10 +2,48 @@
 
 from nonstdlib import fmt
 
+name = 'global'
+planet = 'earth'
+
 def test_fmt():
     name = 'world'
     assert 'hello {name}' | fmt == 'hello world'
     assert '{0} {name}' | fmt('bye') == 'bye world'
     assert '{greeting} {name}' | fmt(greeting='bye', name='mars') == 'bye mars'
 
+def test_fmt_scope():
+    assert '{name} {planet}' | fmt == 'global earth'
+
+    name = 'local'
+    assert '{name} {planet}' | fmt == 'local earth'
+    assert '{name} {planet}' | fmt(name='kwarg') == 'kwarg earth'
+    assert '{0} {name} {planet}' | fmt('arg') == 'arg local earth'
+
+def test_fmt_fields():
+    import pytest
+
+    x = 3.14159
+    width = 8
+    point = complex(1, 2)
+    words = ['a', 'b']
+
+    assert '{x:{width}.2f}' | fmt == '    3.14'
+    assert '{point.imag} {words[1]!r}' | fmt == "2.0 'b'"
+    assert '{x:.1f} {x:.3f}' | fmt == '3.1 3.142'
+    assert '{{x}} {}' | fmt(1) == '{x} 1'
+
+    with pytest.raises(KeyError):
+        '{undefined}' | fmt
+
+def test_template_cache():
+    from nonstdlib.fmt import _compile_template
+
+    template = _compile_template('{a} {b.c} {d[0]:{e}} {0} {}')
+    assert template.names == ('a', 'b', 'd', 'e')
+    assert template.fields == ('a', 'b.c', 'd[0]', 'e')
+    assert _compile_template('{a} {b.c} {d[0]:{e}} {0} {}') is template
 
+    # The cache shouldn't grow without limit.
+    for i in range(2000):
+        _compile_template('{{{}}}'.format(i))
+    assert _compile_template.cache_info().currsize <= 1024